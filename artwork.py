@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+album art thumbnails. They're fetched, decoded, scaled and dithered on a
+background thread, kept in memory up to `ARTWORK_RAM_BYTES` and on the
+SD card up to `ARTWORK_DISK_BYTES`. `get()` only looks into memory so
+drawing never waits for the network or the SD card
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+import metrics
+
+ARTWORK_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'sonos-lcd', 'artwork')
+
+# thumbnails are palette images (1 byte per pixel)
+ARTWORK_RAM_BYTES = 256 * 1024
+ARTWORK_DISK_BYTES = 4 * 1024 * 1024
+
+# colors per thumbnail, dithering hides the banding of so few colors
+# (and of the panel's 16 bit colors)
+ARTWORK_COLORS = 64
+
+# seconds to wait for the speaker (or a music service) to send the image
+ARTWORK_TIMEOUT = 5
+
+# don't retry images which failed to load, up to this many
+MAX_FAILED = 500
+
+
+def thumbnail(data, size):
+    """
+    decode image data into a dithered palette image of size x size
+    """
+    img = Image.open(BytesIO(data))
+    # lets the JPEG decoder scale down while decoding, much faster
+    img.draft('RGB', (size, size))
+    img = ImageOps.fit(img.convert('RGB'), (size, size), Image.BILINEAR)
+    palette = img.quantize(colors=ARTWORK_COLORS)
+    return img.quantize(palette=palette, dither=Image.FLOYDSTEINBERG)
+
+
+class ArtworkCache():
+    def __init__(self, path=ARTWORK_DIR, ram_bytes=ARTWORK_RAM_BYTES,
+                 disk_bytes=ARTWORK_DISK_BYTES, on_ready=None):
+        """
+        on_ready(uri) is called (from the background thread) when a
+        thumbnail asked for with `get()` is available
+        """
+        self.path = path
+        self.ram_bytes = ram_bytes
+        self.disk_bytes = disk_bytes
+        self.on_ready = on_ready
+        self.size = 0
+        self._images = OrderedDict()
+        self._loading = set()
+        self._failed = set()
+        # the thumbnail asked for last, loads queued for others (albums
+        # scrolled past) are dropped
+        self._wanted = None
+        self._disk_size = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def get(self, uri, size):
+        """
+        thumbnail of uri (size x size palette image) if it's in memory,
+        else None and it's loaded in the background
+        """
+        if not uri:
+            return None
+        key = (uri, size)
+        with self._lock:
+            self._wanted = key
+            img = self._images.get(key)
+            if img is not None:
+                self._images.move_to_end(key)
+                metrics.count('artwork.hit')
+                return img
+            if key in self._loading or key in self._failed:
+                return None
+            self._loading.add(key)
+        metrics.count('artwork.miss')
+        self._executor.submit(self._load, key)
+        return None
+
+    def _file(self, key):
+        uri, size = key
+        return os.path.join(self.path, hashlib.sha1(f'{size} {uri}'.encode()).hexdigest() + '.png')
+
+    def _load(self, key):
+        with self._lock:
+            if key != self._wanted:
+                self._loading.discard(key)
+                metrics.count('artwork.skipped')
+                return
+        # imported here, it pulls in http.client, email and ssl which
+        # would slow down the start
+        import urllib.request
+
+        uri, size = key
+        path = self._file(key)
+        img = None
+        try:
+            with metrics.span('artwork.load'):
+                img = self._read(path)
+                if img is None:
+                    with urllib.request.urlopen(uri, timeout=ARTWORK_TIMEOUT) as f:
+                        data = f.read()
+                    img = thumbnail(data, size)
+                    self._write(path, img)
+        except Exception as e:
+            print(f'could not load album art {uri}: {e}')
+        with self._lock:
+            self._loading.discard(key)
+            if img is None:
+                if len(self._failed) >= MAX_FAILED:
+                    self._failed.clear()
+                self._failed.add(key)
+                return
+            self._images[key] = img
+            self.size += img.width * img.height
+            while self.size > self.ram_bytes and len(self._images) > 1:
+                _, old = self._images.popitem(last=False)
+                self.size -= old.width * old.height
+        if self.on_ready is not None:
+            self.on_ready(uri)
+
+    def _read(self, path):
+        try:
+            img = Image.open(path)
+            img.load()
+        except OSError:
+            return None
+        # mark as recently used for the disk eviction
+        os.utime(path)
+        return img
+
+    def _write(self, path, img):
+        """
+        keep the thumbnail on disk, the least recently used ones are
+        deleted when over `disk_bytes`
+        """
+        os.makedirs(self.path, exist_ok=True)
+        img.save(path)
+        if self._disk_size is None:
+            self._disk_size = sum(e.stat().st_size for e in os.scandir(self.path))
+        else:
+            self._disk_size += os.path.getsize(path)
+        if self._disk_size <= self.disk_bytes:
+            return
+        files = sorted(os.scandir(self.path), key=lambda e: e.stat().st_mtime)
+        for entry in files:
+            if self._disk_size <= self.disk_bytes * 0.9:
+                break
+            self._disk_size -= entry.stat().st_size
+            os.remove(entry.path)
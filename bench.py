@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+benchmark the controller's input and render loop without any hardware
+(no SPI, evdev or tkinter needed):
+
+    ./bench.py [--library-size 10000] [--latency 0.05] [scenario ...]
+    ./bench.py --display
+    ./bench.py --soap [--latency 0.05]
+    ./bench.py --memory [--library-size 100000]
+
+scripted key sequences are replayed against a headless display and a
+mock sonos which adds `latency` to every call to the "speaker".
+With --display the conversion of frames to RGB565 is benchmarked
+instead: adafruit_rgb_display's `image()` against framebuffer.py.
+With --soap soco talks to a local stand-in for a speaker's UPnP server,
+with a new connection per call against connections.py's pool.
+--memory reports the bytes per item of the local library index
+"""
+
+import argparse
+import time
+
+import main
+import metrics
+from mock import HeadlessDisplay, ScriptedKeyboard, SlowSonos
+
+# seconds between two keys, roughly a fast typist
+TYPING = 0.12
+
+SCENARIOS = dict(
+    type=[(TYPING, c) for c in 'computer'] + [(TYPING, 'KEY_BACKSPACE')] * 8,
+    scroll=[(0.5, 'KEY_F2')] + [(0.05, 'KEY_DOWN')] * 150 + [(0.05, 'KEY_UP')] * 150,
+    # holding a key down, faster than frames can be drawn
+    burst=[(0.5, 'KEY_F2')] + [(0.002, 'KEY_DOWN')] * 200,
+    contexts=[(0.3, f'KEY_F{i}') for i in [1, 2, 3, 4] * 5],
+    volume=[(0.1, 'KEY_VOLUMEUP')] * 10 + [(0.1, 'KEY_VOLUMEDOWN')] * 10 +
+    [(0.1, 'KEY_LEFT'), (0.1, 'KEY_RIGHT')] * 5,
+)
+
+
+def run(name, script, library_size, latency):
+    sonos = SlowSonos(library_size=library_size, latency=latency)
+    keyboard = ScriptedKeyboard(script)
+    display = HeadlessDisplay()
+    controller = main.Controller(keyboard, display, sonos)
+
+    metrics.reset()
+    metrics.enable()
+    controller.loop()
+
+    latencies = metrics.Histogram()
+    for _, t in keyboard.latencies:
+        latencies.add(t * 1000)
+    print(f'{name}: {latencies.count} keys, {sonos.calls} sonos calls')
+    print(f'  keypress latency ms: p50 {latencies.percentile(50):.2f}  '
+          f'p90 {latencies.percentile(90):.2f}  p99 {latencies.percentile(99):.2f}  '
+          f'max {latencies.percentile(100):.2f}')
+    print(f'  frames pushed: {display.frames}, '
+          f'{display.pixels / max(display.frames, 1):.0f} pixels per frame')
+    for line in metrics.report().splitlines():
+        print(f'  {line}')
+
+
+class NullPanel():
+    """
+    stands in for the ST7735 driver, `_block()` only counts the bytes
+    which would go over SPI
+    """
+    width = 160
+    height = 128
+
+    def __init__(self):
+        self.bytes = 0
+
+    def _block(self, x0, y0, x1, y1, data):
+        # the SPI layer counts and slices by len(), like this
+        self.bytes += len(data)
+
+    def image(self, img, x=0, y=0):
+        """
+        what adafruit_rgb_display's Display.image() does with numpy
+        """
+        import numpy
+        imwidth, imheight = img.size
+        pixels = numpy.array(img.convert('RGB')).astype('uint16')
+        color = (((pixels[:, :, 0] & 0xF8) << 8) | ((pixels[:, :, 1] & 0xFC) << 3) |
+                 (pixels[:, :, 2] >> 3))
+        data = bytearray(numpy.dstack(((color >> 8) & 0xFF, color & 0xFF)).flatten().tolist())
+        self._block(x, y, x + imwidth - 1, y + imheight - 1, data)
+
+
+def run_display(frames=200):
+    from PIL import Image
+    from framebuffer import Framebuffer565
+
+    image = Image.effect_noise((NullPanel.width, NullPanel.height), 64).convert('RGB')
+    updates = dict(full=None,
+                   one_row=[(10, 95, 160, 106)],
+                   results=[(5, 20 + i * 10, 160, 31 + i * 10) for i in range(7)])
+    for name, boxes in updates.items():
+        panel = NullPanel()
+        start = time.perf_counter()
+        for _ in range(frames):
+            if boxes is None:
+                panel.image(image)
+            else:
+                for box in boxes:
+                    panel.image(image.crop(box), x=box[0], y=box[1])
+        adafruit = (time.perf_counter() - start) / frames, panel.bytes // frames
+
+        panel = NullPanel()
+        fb = Framebuffer565(panel.width, panel.height)
+        start = time.perf_counter()
+        for _ in range(frames):
+            for y0, y1, data in fb.update(image, boxes):
+                panel._block(0, y0, panel.width - 1, y1 - 1, data)
+        native = (time.perf_counter() - start) / frames, panel.bytes // frames
+
+        print(f'{name:8} adafruit image(): {1000 * adafruit[0]:7.3f}ms {adafruit[1]:6} bytes  '
+              f'framebuffer565: {1000 * native[0]:7.3f}ms {native[1]:6} bytes')
+
+
+# a TCP handshake over WiFi takes about one round trip, on localhost
+# it's free, so the stand-in server adds it when accepting a connection
+HANDSHAKE = 0.005
+
+SOAP_RESPONSE = (
+    '<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+    's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+    '<u:GetVolumeResponse xmlns:u="urn:schemas-upnp-org:service:RenderingControl:1">'
+    '<CurrentVolume>42</CurrentVolume></u:GetVolumeResponse></s:Body></s:Envelope>').encode()
+
+
+def soap_server(latency, handshake=HANDSHAKE):
+    """
+    HTTP/1.1 server on a free local port which answers every POST like
+    a speaker answers GetVolume, after `latency` seconds. Accepting a
+    connection takes `handshake` seconds
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import threading
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # send headers and body in one packet, like the speakers do
+        wbufsize = 64 * 1024
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml; charset="utf-8"')
+            self.send_header('Content-Length', str(len(SOAP_RESPONSE)))
+            self.end_headers()
+            self.wfile.write(SOAP_RESPONSE)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        def get_request(self):
+            time.sleep(handshake)
+            return super().get_request()
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_soap(latency, calls=300):
+    import soco
+    import soco.services
+    import connections
+
+    def service(port):
+        s = soco.services.RenderingControl(soco.SoCo('127.0.0.1'))
+        s.base_url = f'http://127.0.0.1:{port}'
+        return s
+
+    def get_volume(s):
+        return s.GetVolume([('InstanceID', 0), ('Channel', 'Master')])
+
+    server = soap_server(0)
+    s = service(server.server_port)
+    for mode in ['new connection', 'keep-alive']:
+        if mode == 'keep-alive':
+            connections.install()
+        get_volume(s)
+        start = time.perf_counter()
+        for _ in range(calls):
+            get_volume(s)
+        print(f'{mode:16} {1000 * (time.perf_counter() - start) / calls:7.3f}ms per call '
+              f'({1000 * HANDSHAKE:.0f}ms handshake)')
+    server.shutdown()
+
+    server = soap_server(latency)
+    s = service(server.server_port)
+    start = time.perf_counter()
+    for _ in range(3):
+        get_volume(s)
+    serial = time.perf_counter() - start
+    start = time.perf_counter()
+    connections.batch(*[lambda: get_volume(s)] * 3)
+    batched = time.perf_counter() - start
+    print(f'3 reads, {1000 * latency:.0f}ms server latency: one after the other '
+          f'{1000 * serial:.1f}ms, batch() {1000 * batched:.1f}ms')
+    server.shutdown()
+
+
+def library_rows(n):
+    """
+    n made up tracks as (title, uri, artist, album art) rows like the
+    index gets them from the speaker
+    """
+    import random
+    rnd = random.Random(42)
+    words = ['love', 'night', 'blue', 'computer', 'android', 'seasons', 'five', 'café',
+             'destruction', 'generation', 'everybody', 'song', 'dance', 'heart']
+    for i in range(n):
+        artist = ' '.join(rnd.choice(words) for _ in range(2)).title()
+        album = ' '.join(rnd.choice(words) for _ in range(rnd.randint(1, 3))).title()
+        title = ' '.join(rnd.choice(words) for _ in range(rnd.randint(1, 4))).title()
+        uri = f'x-file-cifs://nas/Music/{artist}/{album}/{i % 20 + 1:02} {title}.flac'
+        yield title, uri, artist, None
+
+
+def run_memory(n):
+    import os
+    import tempfile
+    import tracemalloc
+    from library import _Entries, _connect
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    items = [(title, uri) for title, uri, _, _ in library_rows(n)]
+    tuples = tracemalloc.get_traced_memory()[0] - before
+    del items
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = _connect(os.path.join(tmp, 'library.sqlite'))
+        db.execute('CREATE TABLE items (context TEXT, title TEXT, uri TEXT, artist TEXT, art TEXT)')
+        db.executemany('INSERT INTO items VALUES (?, ?, ?, ?, ?)',
+                       (('tracks',) + row for row in library_rows(n)))
+        db.commit()
+        # built the way the index is loaded and synced, from an ordered cursor
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        entries = _Entries(db.execute('SELECT title, uri, artist, art FROM items '
+                                      'ORDER BY sort_key(title)'))
+        index, peak = (m - before for m in tracemalloc.get_traced_memory())
+        db.close()
+    tracemalloc.stop()
+
+    print(f'{n} tracks')
+    print(f'  (title, uri) tuples:   {tuples / n:6.1f} bytes per item, {tuples / 2**20:6.1f}MB')
+    print(f'  index (all columns):   {index / n:6.1f} bytes per item, {index / 2**20:6.1f}MB')
+    print(f'  peak while building:   {peak / n:6.1f} bytes per item, {peak / 2**20:6.1f}MB')
+    for name in ['titles', 'uris', 'keys', 'compact_titles', 'compact_artists']:
+        column = getattr(entries, name)
+        size = len(column.buffer) + column.offsets.itemsize * len(column.offsets)
+        print(f'    {name:20} {size / n:6.1f} bytes per item')
+
+
+def _wait_for_result(worker, timeout=5):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        items = worker.result()
+        if items is not None:
+            return items
+        time.sleep(0.01)
+    return None
+
+
+def run_checks(library_size, latency):
+    """
+    replay sequences which broke the background search before, fails
+    with an AssertionError
+    """
+    from search import SearchWorker
+
+    sonos = SlowSonos(library_size=library_size, latency=latency)
+    worker = SearchWorker(sonos)
+    # scrolling past the fetched window and back up within the debounce:
+    # the search is answered from the window while the worker waits
+    worker.submit('albums', '', offset=0)
+    assert _wait_for_result(worker) is not None, 'first search'
+    worker.submit('albums', '', offset=150)
+    time.sleep(worker.debounce / 3)
+    worker.submit('albums', '', offset=1)
+    assert worker.result() is not None, 'window hit'
+    time.sleep(2 * worker.debounce + latency)
+    worker.submit('tracks', 'love')
+    assert _wait_for_result(worker) is not None, 'worker died after a window hit'
+    # the library changed (e.g. the index finished syncing): the same
+    # search has to be asked again instead of served from the windows
+    worker.submit('albums', 'love')
+    before = _wait_for_result(worker)
+    sonos._library['albums'].insert(0, ('Love Synced', 'x-file-cifs://nas/albums/synced'))
+    worker.invalidate()
+    worker.submit('albums', 'love')
+    after = _wait_for_result(worker)
+    assert after is not None and after[0] != before[0], 'results after invalidate()'
+    print('search worker: ok')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the controller loop')
+    parser.add_argument('--library-size', type=int, default=10000,
+                        help='items per context in the mock library')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds every call to the mock speaker takes')
+    parser.add_argument('--display', action='store_true',
+                        help='benchmark RGB565 conversion instead of the controller')
+    parser.add_argument('--soap', action='store_true',
+                        help='benchmark SOAP calls with and without keep-alive')
+    parser.add_argument('--memory', action='store_true',
+                        help='report memory used per item of the library index')
+    parser.add_argument('--check', action='store_true',
+                        help='replay sequences which broke the background search before')
+    parser.add_argument('scenarios', nargs='*',
+                        help=f'scenarios to run ({", ".join(SCENARIOS)}), all by default')
+    args = parser.parse_args()
+    if args.display:
+        run_display()
+        parser.exit()
+    if args.soap:
+        run_soap(args.latency)
+        parser.exit()
+    if args.memory:
+        run_memory(args.library_size)
+        parser.exit()
+    if args.check:
+        run_checks(args.library_size, args.latency)
+        parser.exit()
+
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario {name}')
+    for name in args.scenarios or SCENARIOS:
+        run(name, SCENARIOS[name], args.library_size, args.latency)
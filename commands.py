@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+queue of commands to the speakers, run one after the other on a worker
+thread so the input loop never waits for a speaker.
+
+Commands for a speaker which are still waiting are merged with the next
+one of the same kind: volume changes add up to one absolute volume,
+two play/pause toggles cancel each other out and repeat mode steps add
+up. Only the latest waiting command of a speaker is merged, so the
+order of the commands is kept
+"""
+
+import queue
+import threading
+
+import metrics
+
+# kind -> (merge two waiting arguments into one, is the argument a no-op)
+MERGE = {
+    'volume': (lambda a, b: a + b, lambda diff: diff == 0),
+    'play_pause': (lambda a, b: a + b, lambda toggles: toggles % 2 == 0),
+    'repeat': (lambda a, b: a + b, lambda steps: steps % 3 == 0),
+}
+
+
+class CommandQueue():
+    def __init__(self, execute, on_error=None):
+        """
+        execute(target, kind, arg) runs a command (on the worker thread),
+        e.g. execute(0, 'volume', 6) for speaker 0 and a merged +6.
+        on_error(target, kind, arg, exception) is called if it raised
+        """
+        self.execute = execute
+        self.on_error = on_error
+        self._lock = threading.Lock()
+        # waiting commands as [target, kind, arg], oldest first
+        self._waiting = []
+        self._wakeup = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, target, kind, arg=None):
+        """
+        queue a command, never blocks
+        """
+        with self._lock:
+            last = None
+            for command in reversed(self._waiting):
+                if command[0] == target:
+                    last = command
+                    break
+            if last is not None and last[1] == kind and kind in MERGE:
+                merge, _ = MERGE[kind]
+                last[2] = merge(last[2], arg)
+                metrics.count('commands.merged')
+                return
+            self._waiting.append([target, kind, arg])
+        self._wakeup.put(None)
+
+    def _run(self):
+        while True:
+            self._wakeup.get()
+            with self._lock:
+                if not self._waiting:
+                    continue
+                target, kind, arg = self._waiting.pop(0)
+            if kind in MERGE and MERGE[kind][1](arg):
+                metrics.count('commands.dropped')
+                continue
+            try:
+                with metrics.span(f'commands.{kind}'):
+                    self.execute(target, kind, arg)
+            except Exception as e:
+                metrics.count('commands.failed')
+                if self.on_error is None:
+                    print(f'{kind} on {target} failed: {e}')
+                else:
+                    self.on_error(target, kind, arg, e)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+keep-alive connections for the SOAP requests soco sends to the speakers.
+
+soco calls `requests.post()` for every command, so every call opens (and
+closes) its own TCP connection to port 1400. `install()` hands soco a
+stand-in for the `requests` module which sends everything through one
+`requests.Session`, keeping a pool of open connections per speaker
+"""
+
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import soco
+from requests.adapters import HTTPAdapter
+
+# seconds to wait for a speaker to accept a connection / to answer
+CONNECT_TIMEOUT = 2
+READ_TIMEOUT = 10
+
+# open connections kept per speaker by default, enough for the reads of
+# one `batch()`
+POOL_SIZE = 4
+# speakers connections are kept open to
+MAX_SPEAKERS = 16
+
+# soco modules which send requests
+SOCO_MODULES = ['core', 'events', 'services', 'soap']
+
+_executor = ThreadPoolExecutor(max_workers=2 * POOL_SIZE)
+# timeout of the requests sent by this thread, set by `batch()`
+_local = threading.local()
+
+
+class PooledRequests():
+    """
+    stands in for the `requests` module: requests go through a pooled
+    session, everything else (exceptions, structures, ..) is taken from
+    the real module
+    """
+
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), pool_size=POOL_SIZE):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=MAX_SPEAKERS, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    def request(self, method, url, **kwargs):
+        timeout = getattr(_local, 'timeout', None)
+        if timeout is not None:
+            # soco always passes its own
+            kwargs['timeout'] = timeout
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def install(connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, pool_size=POOL_SIZE):
+    """
+    let soco send all requests over pooled keep-alive connections. soco
+    passes its `REQUEST_TIMEOUT` to every call, it's replaced by the
+    given timeouts (seconds)
+    """
+    pooled = PooledRequests((connect_timeout, read_timeout), pool_size)
+    for name in SOCO_MODULES:
+        try:
+            module = importlib.import_module(f'soco.{name}')
+        except ImportError:
+            continue
+        if hasattr(module, 'requests'):
+            module.requests = pooled
+    soco.config.REQUEST_TIMEOUT = (connect_timeout, read_timeout)
+    return pooled
+
+
+def batch(*reads, timeout=None):
+    """
+    run reads (functions without arguments, e.g. `lambda: s.volume`) at
+    the same time on pooled connections, instead of one round trip after
+    the other. Returns their results in order, raises the first error
+
+    timeout: seconds every request of the reads may take, instead of the
+             timeouts given to `install()`
+    """
+    futures = [_executor.submit(_read, read, timeout) for read in reads]
+    return [f.result() for f in futures]
+
+
+def _read(read, timeout):
+    _local.timeout = timeout
+    try:
+        return read()
+    finally:
+        _local.timeout = None
@@ -0,0 +1,512 @@
+#!/usr/bin/env python
+"""
+optional daemon which owns the speakers for all controllers of a
+network: discovery, the library index, the event subscriptions and the
+command queues live in one process and any number of controllers talk to
+it over a Unix or TCP socket, so another controller adds no requests to
+the speakers.
+
+usage: `./daemon.py [address]` and start the controllers with
+`SONOS_LCD_DAEMON=<address>`. address is the path of a Unix socket
+(default `DAEMON_ADDRESS`) or host:port.
+
+The protocol is one JSON array per line:
+
+> client -> daemon  [id, method, args]    id 0 if no answer is wanted
+> daemon -> client  [id, result] or [id, null, error]
+>                   [0, kind, snapshot]   pushed on every change, kind
+>                                         as in `Sonos.add_listener()`
+
+the snapshot has everything `Controller` reads without asking (speakers,
+their states, what's playing, ..) so only searches are round trips
+"""
+
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+
+import metrics
+from state import SpeakerState
+
+DAEMON_ADDRESS = '/tmp/sonos_lcd.sock'
+
+# state refreshes asked for by clients (when there are no events) are
+# sent to the speakers at most this often (seconds)
+REFRESH_INTERVAL = 2
+
+# seconds a client waits for an answer, and before connecting again
+REQUEST_TIMEOUT = 10
+RECONNECT_INTERVAL = 2
+
+# album art urls a client keeps, they're asked for on every frame
+ART_CACHE_SIZE = 1000
+
+# queries (searches, ..) the daemon answers at the same time
+QUERY_WORKERS = 8
+
+# methods of `Sonos` clients may call without waiting for an answer,
+# and the ones which are answered
+COMMANDS = ['play', 'add_to_queue', 'next', 'previous', 'change_volume', 'play_pause',
+            'cycle_repeat', 'reindex']
+QUERIES = ['search', 'album_art']
+
+
+class Station():
+    """
+    a radio station of a search result, clients send it back as they got
+    it when it's played
+    """
+    __slots__ = ('title', 'uri')
+
+    def __init__(self, title, uri):
+        self.title = title
+        self.uri = uri
+
+
+def _encode(obj):
+    # radio stations are the only items which are no JSON types
+    return {'radio': [obj.title, obj.uri]}
+
+
+def _decoder(station):
+    def decode(d):
+        if 'radio' in d:
+            return station(*d['radio'])
+        return d
+    return decode
+
+
+def _dumps(message):
+    return (json.dumps(message, separators=(',', ':'), ensure_ascii=False,
+                       default=_encode) + '\n').encode()
+
+
+def parse_address(address):
+    """
+    (host, port) for 'host:port', else the path of a Unix socket
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return host, int(port)
+    return address
+
+
+class _Client():
+    """
+    a connected controller. Messages to it are sent by its own thread so
+    a slow client never holds up the others or the speaker events
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.asleep = False
+        self._out = queue.Queue()
+        threading.Thread(target=self._send, daemon=True).start()
+
+    def send(self, message):
+        self._out.put(_dumps(message))
+
+    def close(self):
+        self._out.put(None)
+
+    def _send(self):
+        while True:
+            data = self._out.get()
+            if data is None:
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                return
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.owner.serve_client(self.request, self.rfile)
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon():
+    def __init__(self, sonos, address=DAEMON_ADDRESS, station=Station):
+        """
+        sonos: the `Sonos` all clients share
+        station: class of the radio stations in sonos' search results
+        """
+        self.sonos = sonos
+        self.address = parse_address(address)
+        self._decode = _decoder(station)
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._refreshed = 0
+        self._paused = False
+        self._queries = ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+        sonos.add_listener(self._notify)
+
+    def serve_forever(self):
+        if isinstance(self.address, tuple):
+            server = _TCPServer(self.address, _Handler)
+        else:
+            if os.path.exists(self.address):
+                # left over by a daemon which did not exit cleanly
+                os.remove(self.address)
+            server = _UnixServer(self.address, _Handler)
+        server.owner = self
+        server.serve_forever()
+
+    def serve_client(self, sock, rfile):
+        client = _Client(sock)
+        with self._lock:
+            self._clients.add(client)
+        self._update_pause()
+        client.send([0, 'speakers', self._snapshot()])
+        metrics.count('daemon.connected')
+        try:
+            for line in rfile:
+                try:
+                    request_id, method, args = json.loads(line, object_hook=self._decode)
+                except ValueError as e:
+                    print(f'invalid request {line[:80]}: {e}')
+                    continue
+                self._handle(client, request_id, method, args)
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._clients.discard(client)
+            client.close()
+            self._update_pause()
+
+    def _handle(self, client, request_id, method, args):
+        if method in QUERIES:
+            # answered on another thread so a slow search does not hold
+            # up the requests the client sends after it
+            self._queries.submit(self._run, client, request_id, method, args)
+        else:
+            self._run(client, request_id, method, args)
+
+    def _run(self, client, request_id, method, args):
+        try:
+            with metrics.span(f'daemon.{method}'):
+                if method in QUERIES or method in COMMANDS:
+                    result = getattr(self.sonos, method)(*args)
+                elif method == 'refresh_states':
+                    result = self._refresh()
+                elif method in ('pause', 'resume'):
+                    client.asleep = method == 'pause'
+                    result = self._update_pause()
+                    if not client.asleep:
+                        # nothing was pushed while it was asleep
+                        client.send([0, 'state', self._snapshot()])
+                else:
+                    raise ValueError(f'unknown method {method}')
+        except Exception as e:
+            if request_id:
+                client.send([request_id, None, str(e)])
+            else:
+                print(f'{method} failed: {e}')
+            return
+        if request_id:
+            client.send([request_id, result])
+
+    def _refresh(self):
+        """
+        fetch the speaker states, unless a client asked for it just now
+        """
+        with self._lock:
+            if timer() - self._refreshed < REFRESH_INTERVAL:
+                metrics.count('daemon.refresh_dropped')
+                return
+            self._refreshed = timer()
+        self.sonos.refresh_states()
+
+    def _update_pause(self):
+        """
+        the speakers are left alone (see `Sonos.pause()`) while every
+        client sleeps
+        """
+        with self._lock:
+            paused = all(c.asleep for c in self._clients)
+            if paused == self._paused:
+                return
+            self._paused = paused
+        if paused:
+            self.sonos.pause()
+        else:
+            self.sonos.resume()
+
+    def _snapshot(self):
+        s = self.sonos
+        speakers = s.speakers()
+        states = [s.state(n) for n in range(len(speakers))]
+        return dict(speakers=speakers,
+                    states=[[st.transport_state, st.play_mode, st.volume] for st in states],
+                    playing=[s.now_playing(n) for n in range(len(speakers))],
+                    status=s.speaker_status(),
+                    subscribed=s.subscribed(),
+                    progress=s.library_progress())
+
+    def _notify(self, kind):
+        snapshot = self._snapshot()
+        with self._lock:
+            clients = [c for c in self._clients if not c.asleep]
+        for client in clients:
+            client.send([0, kind, snapshot])
+
+
+class SonosClient():
+    def __init__(self, address=DAEMON_ADDRESS, timeout=REQUEST_TIMEOUT):
+        """
+        stands in for `sonos.Sonos`, everything goes through the daemon
+        at address. What the daemon pushes is kept, so reading states
+        never waits; only searches are round trips. Waits (up to timeout
+        seconds) for the first snapshot
+        """
+        self.address = parse_address(address)
+        self.timeout = timeout
+        self._listeners = []
+        # (snapshot, [SpeakerState]) as last pushed
+        self._current = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._sock = None
+        self._ids = itertools.count(1)
+        # request id -> [answered event, answer]
+        self._waiting = {}
+        self._art = {}
+        self._art_loading = set()
+        self._art_executor = ThreadPoolExecutor(max_workers=1)
+        self._asleep = False
+        threading.Thread(target=self._run, daemon=True).start()
+        if not self._ready.wait(timeout):
+            raise ConnectionError(f'no answer from the sonos daemon at {address}')
+
+    def _connect(self):
+        if isinstance(self.address, tuple):
+            sock = socket.create_connection(self.address)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.address)
+        return sock
+
+    def _run(self):
+        decode = _decoder(Station)
+        while True:
+            try:
+                sock = self._connect()
+            except OSError as e:
+                print(f'could not connect to the sonos daemon: {e}')
+                time.sleep(RECONNECT_INTERVAL)
+                continue
+            self._sock = sock
+            if self._asleep:
+                self._command('pause')
+            try:
+                for line in sock.makefile('rb'):
+                    self._receive(json.loads(line, object_hook=decode))
+            except (OSError, ValueError) as e:
+                print(f'lost the connection to the sonos daemon: {e}')
+            with self._lock:
+                self._sock = None
+                waiting, self._waiting = self._waiting, {}
+            for answered, _ in waiting.values():
+                answered.set()
+            sock.close()
+            time.sleep(RECONNECT_INTERVAL)
+
+    def _receive(self, message):
+        if message[0] == 0:
+            _, kind, snapshot = message
+            self._update(snapshot)
+            if kind == 'library':
+                self._art = {}
+            self._ready.set()
+            for callback in self._listeners:
+                callback(kind)
+            return
+        with self._lock:
+            waiting = self._waiting.get(message[0])
+        if waiting is not None:
+            waiting[1] = message
+            waiting[0].set()
+
+    def _update(self, snapshot):
+        states = []
+        for (transport_state, play_mode, volume), track in zip(snapshot['states'],
+                                                                snapshot['playing']):
+            state = SpeakerState()
+            state.transport_state = transport_state
+            state.play_mode = play_mode
+            state.volume = volume
+            state.track = tuple(track) if track else None
+            states.append(state)
+        self._current = (snapshot, states)
+
+    def _send(self, message):
+        sock = self._sock
+        if sock is None:
+            raise ConnectionError('not connected to the sonos daemon')
+        with self._send_lock:
+            sock.sendall(_dumps(message))
+
+    def _command(self, method, *args):
+        try:
+            self._send([0, method, list(args)])
+        except OSError as e:
+            print(f'{method} failed: {e}')
+            for callback in self._listeners:
+                callback('failed')
+
+    def _call(self, method, *args):
+        request_id = next(self._ids)
+        waiting = [threading.Event(), None]
+        with self._lock:
+            self._waiting[request_id] = waiting
+        try:
+            self._send([request_id, method, list(args)])
+            if not waiting[0].wait(self.timeout):
+                raise TimeoutError(f'no answer from the sonos daemon to {method}')
+        finally:
+            with self._lock:
+                self._waiting.pop(request_id, None)
+        answer = waiting[1]
+        if answer is None:
+            raise ConnectionError('lost the connection to the sonos daemon')
+        if len(answer) > 2:
+            raise RuntimeError(answer[2])
+        return answer[1]
+
+    def speakers(self):
+        return list(self._current[0]['speakers'])
+
+    def add_listener(self, callback):
+        """
+        see `Sonos.add_listener()`
+        """
+        self._listeners.append(callback)
+
+    def subscribed(self):
+        return self._current[0]['subscribed']
+
+    def pause(self):
+        self._asleep = True
+        self._command('pause')
+
+    def resume(self):
+        self._asleep = False
+        self._command('resume')
+
+    def search(self, context, term, offset=0, max_items=7, debug=False):
+        return [tuple(i) for i in self._call('search', context, term, offset, max_items)]
+
+    def play(self, speaker_number, uri):
+        self._command('play', speaker_number, uri)
+
+    def add_to_queue(self, speaker_number, uri):
+        self._command('add_to_queue', speaker_number, uri)
+
+    def state(self, speaker_number):
+        return self._current[1][speaker_number]
+
+    def now_playing(self, speaker_number):
+        track = self._current[0]['playing'][speaker_number]
+        return tuple(track) if track else None
+
+    def album_art(self, context, uri):
+        """
+        album art url of a search result, None if unknown. Never blocks:
+        urls which are not known yet are asked for in the background,
+        listeners are called with kind 'art' once it's there
+        """
+        key = (context, uri)
+        art = self._art
+        if key in art:
+            return art[key]
+        with self._lock:
+            if key in self._art_loading:
+                return None
+            self._art_loading.add(key)
+        self._art_executor.submit(self._load_art, key)
+        return None
+
+    def _load_art(self, key):
+        try:
+            url = self._call('album_art', *key)
+        except (OSError, RuntimeError) as e:
+            # asked for again on the next `album_art()`
+            print(f'could not get album art of {key[1]}: {e}')
+            with self._lock:
+                self._art_loading.discard(key)
+            return
+        with self._lock:
+            self._art_loading.discard(key)
+            if len(self._art) >= ART_CACHE_SIZE:
+                self._art = {}
+            self._art[key] = url
+        if url is not None:
+            for callback in self._listeners:
+                callback('art')
+
+    def volume_play_as_string(self, speaker_number, debug=False):
+        state = self.state(speaker_number)
+        if not state.complete():
+            return ''
+        return state.as_string()
+
+    def speaker_status(self):
+        return list(self._current[0]['status'])
+
+    def refresh_states(self, speaker_numbers=None):
+        self._command('refresh_states')
+
+    def library_progress(self):
+        return self._current[0]['progress']
+
+    def next(self, speaker_number):
+        self._command('next', speaker_number)
+
+    def previous(self, speaker_number):
+        self._command('previous', speaker_number)
+
+    def change_volume(self, speaker_number, diff):
+        self._command('change_volume', speaker_number, diff)
+
+    def play_pause(self, speaker_number):
+        self._command('play_pause', speaker_number)
+
+    def cycle_repeat(self, speaker_number):
+        self._command('cycle_repeat', speaker_number)
+
+    def reindex(self):
+        self._command('reindex')
+
+
+def main():
+    address = sys.argv[1] if len(sys.argv) > 1 else DAEMON_ADDRESS
+    if os.environ.get('SONOS_LCD_METRICS'):
+        metrics.enable()
+    metrics.install_signal_handler('/tmp/sonos_lcd_daemon_metrics.txt')
+    from sonos import RadioStation, Sonos
+    print(f'serving sonos on {address}')
+    Daemon(Sonos(), address, station=RadioStation).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+persistent RGB565 copy of the panel's content. Only the rows which
+changed are converted from the PIL image, and they are handed to SPI as
+views into the buffer, so nothing is reallocated per frame
+"""
+
+import numpy
+
+
+class Framebuffer565():
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        # the panel wants big endian RGB565
+        self.buffer = numpy.zeros((height, width), dtype='>u2')
+        self._bytes = self.buffer.view(numpy.uint8).reshape(height, width * 2)
+        self._color = numpy.empty((height, width), dtype=numpy.uint16)
+        self._tmp = numpy.empty((height, width), dtype=numpy.uint16)
+
+    def row_ranges(self, boxes):
+        """
+        merge (x0, y0, x1, y1) boxes into sorted, non overlapping (y0, y1)
+        row ranges. Whole rows are sent so every range is one contiguous
+        block of the buffer
+        """
+        if boxes is None:
+            return [(0, self.height)]
+        ranges = []
+        for _, y0, _, y1 in sorted(boxes, key=lambda b: b[1]):
+            y0, y1 = max(0, y0), min(self.height, y1)
+            if y0 >= y1:
+                continue
+            if ranges and y0 <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], y1))
+            else:
+                ranges.append((y0, y1))
+        return ranges
+
+    def update(self, image, boxes=None):
+        """
+        convert the rows of `image` covered by boxes (all if None) and
+        return a list of (y0, y1, data), data being a flat byte memoryview
+        of those rows in the buffer, ready to be written to the panel
+        """
+        res = []
+        for y0, y1 in self.row_ranges(boxes):
+            rgb = numpy.asarray(image.crop((0, y0, self.width, y1)))
+            color = self._color[y0:y1]
+            tmp = self._tmp[y0:y1]
+            # rrrrrggg gggbbbbb
+            numpy.bitwise_and(rgb[..., 0], 0xF8, out=color)
+            numpy.left_shift(color, 8, out=color)
+            numpy.bitwise_and(rgb[..., 1], 0xFC, out=tmp)
+            numpy.left_shift(tmp, 3, out=tmp)
+            numpy.bitwise_or(color, tmp, out=color)
+            numpy.right_shift(rgb[..., 2], 3, out=tmp)
+            numpy.bitwise_or(color, tmp, out=color)
+            self.buffer[y0:y1] = color
+            # 1-D so len() is the number of bytes, like for a bytearray
+            res.append((y0, y1, memoryview(self._bytes[y0:y1]).cast('B')))
+        return res
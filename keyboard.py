@@ -1,6 +1,20 @@
 #!/usr/bin/env python
-import evdev
+"""
+keys of the Rii keyboard (letters and arrows on one input device, media
+keys on another). One thread reads both devices and puts the keys into a
+single queue, whoever is showing something (main loop, dialogue, sleep)
+takes them from there. Unplugged devices are opened again as soon as
+they're back
+"""
+
+import queue
 import selectors
+import threading
+import time
+
+import evdev
+
+import metrics
 
 LETTERS = dict(q=16, w=17, e=18, r=19, t=20, z=21, u=22, i=23, o=24, p=25,
                a=30, s=31, d=32, f=33, g=34, h=35, j=36, k=37, l=38,
@@ -11,8 +25,164 @@ LETTERS_MAP = {v: k for k, v in LETTERS.items()}
 FORMAT = 'llHHI'
 # EVENT_SIZE = struct.calcsize(FORMAT)
 
-KEYBOARD = evdev.InputDevice('/dev/input/event0')
-MEDIA = evdev.InputDevice('/dev/input/event3')
+DEVICES = ['/dev/input/event0', '/dev/input/event3']
+
+# look for unplugged devices this often (seconds)
+HOTPLUG_INTERVAL = 2
+
+_service = None
+
+
+class InputService():
+    def __init__(self, paths=DEVICES, debug=False):
+        self.paths = paths
+        self.debug = debug
+        # (event timestamp, key) in the order the keys were pressed
+        self.keys = queue.Queue()
+        self._selector = selectors.DefaultSelector()
+        self._devices = {}
+        # path -> device name, to find a device again if it comes back
+        # under another path
+        self._names = {}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _open_missing(self):
+        available = None
+        for path in self.paths:
+            if path in self._devices:
+                continue
+            try:
+                device = evdev.InputDevice(path)
+            except OSError:
+                device = None
+            if device is None and path in self._names:
+                # replugged devices often get a new event number
+                if available is None:
+                    available = evdev.list_devices()
+                for other in available:
+                    if other in self.paths or other in (d.path for d in self._devices.values()):
+                        continue
+                    try:
+                        candidate = evdev.InputDevice(other)
+                    except OSError:
+                        continue
+                    if candidate.name == self._names[path]:
+                        device = candidate
+                        break
+                    candidate.close()
+            if device is None:
+                continue
+            if self.debug:
+                print(f'input device {device.path}: {device.name}')
+            self._names[path] = device.name
+            self._devices[path] = device
+            self._selector.register(device, selectors.EVENT_READ, path)
+
+    def _close(self, path):
+        device = self._devices.pop(path)
+        self._selector.unregister(device)
+        try:
+            device.close()
+        except OSError:
+            pass
+        if self.debug:
+            print(f'input device {path} is gone')
+
+    def _run(self):
+        last_scan = 0
+        while True:
+            if len(self._devices) < len(self.paths) and time.monotonic() - last_scan > HOTPLUG_INTERVAL:
+                self._open_missing()
+                last_scan = time.monotonic()
+            if not self._devices:
+                time.sleep(HOTPLUG_INTERVAL)
+                continue
+            events = []
+            # with all devices there the thread only wakes up for keys
+            missing = len(self._devices) < len(self.paths)
+            for key, _ in self._selector.select(HOTPLUG_INTERVAL if missing else None):
+                try:
+                    for event in key.fileobj.read():
+                        if event.type == evdev.ecodes.EV_KEY and event.value != 0:
+                            events.append((event.timestamp(), event.code))
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    # unplugged
+                    self._close(key.data)
+            for timestamp, scancode in sorted(events):
+                key = evdev.ecodes.KEY[scancode]
+                if self.debug:
+                    print(key)
+                self.keys.put((timestamp, LETTERS_MAP.get(scancode, key)))
+
+    def wake(self):
+        """
+        let a `get()` with a timeout return None right away, e.g. when a
+        background search finished
+        """
+        self.keys.put((None, None))
+
+    def get(self, timeout=None):
+        """
+        next key, None if none was pressed within timeout seconds or
+        `wake()` was called. Keys are taken one by one, so a consumer
+        which stops (e.g. a dialogue after enter) leaves the rest for the
+        next one
+        """
+        if timeout is not None:
+            timeout = max(timeout, 0)
+        while True:
+            try:
+                timestamp, key = self.keys.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if key is not None:
+                break
+            if timeout is not None:
+                return None
+        # event timestamps are wall clock time
+        metrics.observe('input.queued', time.time() - timestamp, unit='s')
+        return key
+
+    def batches(self, timeout=None):
+        """
+        yield lists of all keys pressed since the last batch, an empty
+        list if none was pressed within timeout seconds (or a function
+        returning them, asked before every wait)
+        """
+        while True:
+            key = self.get(timeout() if callable(timeout) else timeout)
+            if key is None:
+                yield []
+                continue
+            pressed = [key]
+            while True:
+                key = self.get(0)
+                if key is None:
+                    break
+                pressed.append(key)
+            yield pressed
+
+
+def open_devices(debug=False):
+    """
+    start reading the input devices, done on first use and not at
+    import time
+    """
+    global _service
+    if _service is None:
+        _service = InputService(debug=debug)
+
+
+def wake():
+    """
+    end the current wait for keys (with a timeout) early, can be called
+    from any thread
+    """
+    if _service is not None:
+        _service.wake()
 
 
 def getch_generator(debug=False, timeout=None):
@@ -31,26 +201,20 @@ def getch_generator(debug=False, timeout=None):
              after 0.5s with no input None is returned (timeout mode).
              If set to -1 then it immediately returns (non blocking mode)
     """
-    selector = selectors.DefaultSelector()
-    selector.register(KEYBOARD, selectors.EVENT_READ)
-    selector.register(MEDIA, selectors.EVENT_READ)
+    open_devices(debug)
     while True:
-        in_timeout = True
-        for key, mask in selector.select(timeout):
-            in_timeout = False
-            device = key.fileobj
-            for event in device.read():
-                if event.type == evdev.ecodes.EV_KEY and event.value != 0:
-                    scancode = event.code
-                    key = evdev.ecodes.KEY[scancode]
-                    if debug:
-                        print(key)
-                    if scancode in LETTERS_MAP:
-                        yield LETTERS_MAP[scancode]
-                    else:
-                        yield key
-        if in_timeout:
-            yield None
+        yield _service.get(timeout)
+
+
+def getch_batches(debug=False, timeout=None):
+    """
+    like getch_generator() but yields lists of all keys pressed since the
+    last batch, so a burst of keys can be handled at once.
+    An empty list is yielded on timeout or `wake()`. timeout can be a
+    function returning the seconds to wait for the next batch
+    """
+    open_devices(debug)
+    yield from _service.batches(timeout)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,567 @@
+#!/usr/bin/env python
+"""
+local index of the music library so type-ahead search does not need
+a UPnP round trip to the speaker for every keypress.
+
+Short terms are answered with a prefix lookup on the sorted titles
+followed by a substring scan. From `FUZZY_MIN_LENGTH` characters on
+results are ranked: titles and artists are compared without case,
+spaces and punctuation ("okcomp" finds "OK Computer"), letters may be
+left out ("okcmptr") and recently played items get a boost. Every
+keystroke only re-checks the matches of the term typed before.
+
+The index is kept in sync with the SystemUpdateID of the speaker's
+content directory and the update ids of the albums, tracks and artists
+containers, so only what changed is browsed again
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+CONTEXTS = ['albums', 'tracks', 'artists']
+
+# how many items to fetch per browse request while building the index
+BROWSE_PAGE = 500
+# browse requests sent at the same time, and how many pages may be
+# fetched ahead of the one which is written to the index
+BROWSE_WORKERS = 4
+BROWSE_AHEAD = 2 * BROWSE_WORKERS
+
+# row of the `synced` table with the SystemUpdateID of the last sync
+SYSTEM_ID = 'system'
+
+# terms shorter than this match too much for ranking to be useful (or fast)
+FUZZY_MIN_LENGTH = 3
+
+# how many ranked match lists are kept for narrowing and paging
+MATCH_CACHE_SIZE = 32
+
+# score of a match, higher is better
+SCORE_PREFIX = 1000
+SCORE_WORD_PREFIX = 800
+SCORE_SUBSTRING = 600
+SCORE_ARTIST_PREFIX = 500
+SCORE_ARTIST_SUBSTRING = 400
+SCORE_FUZZY = 200
+SCORE_ARTIST_FUZZY = 100
+# added per recorded play, up to MAX_PLAYS plays
+SCORE_PLAY = 60
+MAX_PLAYS = 5
+
+_NOT_ALNUM = re.compile(r'[\W_]+')
+
+
+def compact(text):
+    """
+    lowercase text without whitespace and punctuation
+    """
+    return _NOT_ALNUM.sub('', text.lower())
+
+
+def sort_key(title):
+    """
+    what items are sorted and prefix searched by, also registered as
+    sqlite function so the index can be read in this order
+    """
+    return title.lower().replace('\n', ' ')
+
+
+def _connect(path):
+    db = sqlite3.connect(path)
+    db.create_function('sort_key', 1, sort_key)
+    return db
+
+
+class _Column():
+    """
+    strings stored back to back in one utf-8 buffer, `offsets` (n + 1
+    ints) marks where each one starts. That's a few bytes per string
+    instead of a python object each. `sep` follows every string so a
+    search in the buffer can't match across two of them.
+    Strings are appended one by one, `close()` makes the buffer bytes
+    """
+
+    def __init__(self, sep=b''):
+        self.sep = sep
+        self.buffer = bytearray()
+        self.offsets = array('I', [0])
+
+    def append(self, string):
+        self.buffer += string.encode()
+        self.buffer += self.sep
+        self.offsets.append(len(self.buffer))
+
+    def close(self):
+        self.buffer = bytes(self.buffer)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.raw(i).decode()
+
+    def raw(self, i):
+        return self.buffer[self.offsets[i]:self.offsets[i + 1] - len(self.sep)]
+
+    def index(self, pos):
+        """
+        index of the string at byte pos of the buffer
+        """
+        return bisect_right(self.offsets, pos) - 1
+
+    def find(self, term):
+        """
+        yield indexes of strings containing term (bytes), in order
+        """
+        pos = self.buffer.find(term)
+        while pos != -1:
+            i = self.index(pos)
+            yield i
+            pos = self.buffer.find(term, self.offsets[i + 1])
+
+    def matches(self, pattern):
+        """
+        yield indexes of strings (compiled bytes) pattern matches, one
+        regular expression scan instead of a python loop over all strings
+        """
+        pos = 0
+        while True:
+            m = pattern.search(self.buffer, pos)
+            if m is None:
+                return
+            i = self.index(m.start())
+            yield i
+            pos = self.offsets[i + 1]
+
+
+class _Entries():
+    """
+    all items of one context, sorted by lowercased title, as columns:
+
+    - `titles`, `uris`: what search results are made of
+    - `keys`: lowercased titles, prefix search is a binary search on
+      them and substring search a `bytes.find` on their buffer
+    - `compact_titles`, `compact_artists`: `compact()` form for ranked
+      search
+    """
+
+    def __init__(self, rows):
+        """
+        rows: (title, uri, artist, album art uri) sorted by `sort_key()`
+              of the title, e.g. an sqlite cursor. They're added one by
+              one, never all held as python objects at once
+        """
+        self.titles = _Column()
+        self.uris = _Column()
+        self.keys = _Column(b'\n')
+        self.compact_titles = _Column(b'\n')
+        self.compact_artists = _Column(b'\n')
+        # uri -> album art uri, only albums have one
+        self.art = {}
+        for title, uri, artist, art in rows:
+            self.titles.append(title)
+            self.uris.append(uri)
+            self.keys.append(sort_key(title))
+            self.compact_titles.append(compact(title))
+            self.compact_artists.append(compact(artist or ''))
+            if art:
+                self.art[uri] = art
+        for column in (self.titles, self.uris, self.keys, self.compact_titles,
+                       self.compact_artists):
+            column.close()
+
+    def __len__(self):
+        return len(self.titles)
+
+    def item(self, i):
+        """
+        (title, uri) of item i
+        """
+        return self.titles[i], self.uris[i]
+
+    def _bisect(self, term):
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.keys.raw(mid) < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def prefix(self, term):
+        """
+        return (lo, hi) range of items starting with term
+        """
+        term = term.encode()
+        # utf-8 never contains 0xff
+        return self._bisect(term), self._bisect(term + b'\xff')
+
+    def substring(self, term):
+        """
+        yield indexes of items containing term, in title order
+        """
+        return self.keys.find(term.encode())
+
+
+def _fuzzy_pattern(term):
+    """
+    regex matching lines which contain the letters of term in order,
+    gaps allowed but not across lines
+    """
+    return re.compile(b'[^\n]*?'.join(re.escape(c.encode()) for c in term))
+
+
+class LibraryIndex():
+    def __init__(self, path, on_change=None):
+        """
+        path: sqlite file the index is persisted to, it's loaded by
+              the first `sync()` (in its thread) if it exists. Play
+              counts are kept in `plays.json` next to it
+        on_change(context): called (from the sync thread) with the
+                   context which was swapped in, or None when the sync
+                   progressed
+        """
+        self.path = path
+        self.on_change = on_change
+        self._plays_path = os.path.join(os.path.dirname(path), 'plays.json')
+        self._entries = {}
+        self._plays = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._loaded = False
+        # arguments of the next sync
+        self._requested = None
+        self._progress = None
+        # (context, compact term) -> ranked indexes of matching items
+        self._matches = OrderedDict()
+        self._matches_lock = threading.Lock()
+        self._load_plays()
+
+    def ready(self):
+        return len(self._entries) == len(CONTEXTS)
+
+    def building(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _load_plays(self):
+        try:
+            with open(self._plays_path) as f:
+                self._plays = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def load(self):
+        """
+        read the persisted index, searching falls back to the speaker
+        until it's done
+        """
+        if not os.path.exists(self.path):
+            return
+        db = _connect(self.path)
+        try:
+            entries = {context: self._read(db, context) for context in CONTEXTS}
+        except sqlite3.Error as e:
+            # e.g. an index written by an older version, gets rebuilt
+            print(f'could not load library index: {e}')
+            return
+        finally:
+            db.close()
+        self._set_entries(entries)
+        for context in entries:
+            self._changed(context)
+
+    def _read(self, db, context):
+        return _Entries(db.execute('SELECT title, uri, artist, art FROM items '
+                                   'WHERE context = ? ORDER BY sort_key(title)', (context,)))
+
+    def _set_entries(self, entries):
+        with self._matches_lock:
+            self._entries = entries
+            self._matches.clear()
+
+    def record_play(self, uri):
+        """
+        count a play of uri, recently played items rank higher in search
+        """
+        if not isinstance(uri, str):
+            return
+        plays = dict(self._plays)
+        plays[uri] = plays.get(uri, 0) + 1
+        # forget the least played ones, so the file does not grow forever
+        if len(plays) > 1000:
+            plays = dict(sorted(plays.items(), key=lambda p: -p[1])[:500])
+        self._plays = plays
+        with self._matches_lock:
+            self._matches.clear()
+        try:
+            os.makedirs(os.path.dirname(self._plays_path), exist_ok=True)
+            with open(self._plays_path, 'w') as f:
+                json.dump(plays, f)
+        except OSError as e:
+            print(f'could not save play counts: {e}')
+
+    def search(self, context, term, offset=0, max_items=7):
+        """
+        short terms: items whose title starts with `term` come first, then
+        the ones which contain it somewhere else.
+        Longer terms: all fuzzy matches, best first (see `_rank`).
+        Returns None if the context is not indexed (yet)
+        """
+        entries = self._entries.get(context)
+        if entries is None:
+            return None
+        term = term.lower()
+        if not term:
+            return [entries.item(i) for i in range(len(entries))[offset:offset + max_items]]
+
+        if len(compact(term)) >= FUZZY_MIN_LENGTH:
+            ranked = self._ranked(context, entries, term)
+            return [entries.item(i) for i in ranked[offset:offset + max_items]]
+
+        lo, hi = entries.prefix(term)
+        res = [entries.item(i) for i in range(lo, hi)[offset:offset + max_items]]
+        skip = max(0, offset - (hi - lo))
+        if len(res) < max_items:
+            for i in entries.substring(term):
+                if lo <= i < hi:
+                    continue
+                if skip > 0:
+                    skip -= 1
+                    continue
+                res.append(entries.item(i))
+                if len(res) >= max_items:
+                    break
+        return res
+
+    def album_art(self, context, uri):
+        """
+        album art uri (relative to the speaker) of an item, None if it
+        has none or the context is not indexed
+        """
+        entries = self._entries.get(context)
+        if entries is None:
+            return None
+        return entries.art.get(uri)
+
+    def _ranked(self, context, entries, term):
+        """
+        indexes of all items matching term, best first. Paging through
+        the results is served from the cache, and the matches of a term
+        are the candidates for every term typed after it
+        """
+        key = (context, compact(term))
+        with self._matches_lock:
+            if key in self._matches:
+                self._matches.move_to_end(key)
+                return self._matches[key]
+            # the longest cached term this one extends
+            candidates = None
+            for n in range(len(key[1]) - 1, FUZZY_MIN_LENGTH - 1, -1):
+                candidates = self._matches.get((context, key[1][:n]))
+                if candidates is not None:
+                    break
+
+        ranked = self._rank(entries, term, key[1], candidates)
+        with self._matches_lock:
+            if self._entries.get(context) is entries:
+                self._matches[key] = ranked
+                while len(self._matches) > MATCH_CACHE_SIZE:
+                    self._matches.popitem(last=False)
+        return ranked
+
+    def _rank(self, entries, term, compact_term, candidates=None):
+        """
+        score every item (or only candidates) containing the letters of
+        compact_term in order, in its title or its artist. Ties go to the
+        shorter title
+        """
+        pattern = _fuzzy_pattern(compact_term)
+        titles, artists = entries.compact_titles, entries.compact_artists
+        if candidates is None:
+            candidates = set(titles.matches(pattern))
+            candidates.update(artists.matches(pattern))
+        else:
+            candidates = [i for i in candidates
+                          if pattern.search(titles.raw(i)) or pattern.search(artists.raw(i))]
+
+        plays = {uri.encode(): n for uri, n in self._plays.items()}
+        compact_term = compact_term.encode()
+        word = b' ' + term.encode()
+        scored = []
+        for i in candidates:
+            title = titles.raw(i)
+            if title.startswith(compact_term):
+                score = SCORE_PREFIX
+            elif word in b' ' + entries.keys.raw(i):
+                score = SCORE_WORD_PREFIX
+            elif compact_term in title:
+                score = SCORE_SUBSTRING
+            else:
+                artist = artists.raw(i)
+                if artist.startswith(compact_term):
+                    score = SCORE_ARTIST_PREFIX
+                elif compact_term in artist:
+                    score = SCORE_ARTIST_SUBSTRING
+                else:
+                    m = pattern.search(title)
+                    if m is not None:
+                        # the closer together the letters the better
+                        score = SCORE_FUZZY - (m.end() - m.start() - len(compact_term))
+                    else:
+                        m = pattern.search(artist)
+                        score = SCORE_ARTIST_FUZZY - (m.end() - m.start() - len(compact_term))
+            if plays:
+                played = plays.get(entries.uris.raw(i))
+                if played:
+                    score += SCORE_PLAY * min(played, MAX_PLAYS)
+            scored.append((-score, len(title), i))
+        scored.sort()
+        return array('I', (i for _, _, i in scored))
+
+    def progress(self):
+        """
+        (items fetched, items to fetch) of the running sync, None if
+        there's none
+        """
+        return self._progress
+
+    def sync(self, music_library, update_id=None, wait_for_update=False):
+        """
+        bring the index up to date with the library in a background
+        thread. Nothing is browsed if the SystemUpdateID of the library
+        (update_id, asked for if None) is the one of the last sync, and
+        only contexts whose container changed are browsed again. Each
+        one is searchable as soon as it's complete. A sync asked for
+        while one is running is done after it.
+
+        wait_for_update: wait for a library update on the speaker
+                         (`start_library_update()`) to finish first
+        """
+        with self._lock:
+            self._requested = (music_library, update_id, wait_for_update)
+            if self.building():
+                return
+            self._thread = threading.Thread(target=self._run_syncs, daemon=True)
+            self._thread.start()
+
+    def _run_syncs(self):
+        if not self._loaded:
+            # off the caller's thread, a big index takes a while to read
+            self._loaded = True
+            self.load()
+        while True:
+            with self._lock:
+                if self._requested is None:
+                    self._thread = None
+                    return
+                args, self._requested = self._requested, None
+            try:
+                self._sync(*args)
+            except Exception as e:
+                print(f'could not index library: {e}')
+            finally:
+                if self._progress is not None:
+                    self._progress = None
+                    self._changed()
+
+    def _changed(self, context=None):
+        if self.on_change is not None:
+            self.on_change(context)
+
+    def _sync(self, music_library, update_id, wait_for_update):
+        if wait_for_update:
+            # give the speaker a moment to actually start the update
+            time.sleep(5)
+            while music_library.library_updating:
+                time.sleep(5)
+            update_id = None
+        if update_id is None:
+            update_id = music_library.contentDirectory.GetSystemUpdateID()['Id']
+        update_id = str(update_id)
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        db = _connect(self.path)
+        try:
+            if not self._entries:
+                # nothing (usable) indexed yet, e.g. written by an older version
+                db.execute('DROP TABLE IF EXISTS items')
+                db.execute('DROP TABLE IF EXISTS synced')
+            db.execute('CREATE TABLE IF NOT EXISTS items '
+                       '(context TEXT, title TEXT, uri TEXT, artist TEXT, art TEXT)')
+            db.execute('CREATE TABLE IF NOT EXISTS synced '
+                       '(id TEXT PRIMARY KEY, update_id TEXT, total INTEGER)')
+            synced = {row[0]: row[1:] for row in db.execute('SELECT * FROM synced')}
+            if self.ready() and synced.get(SYSTEM_ID, (None,))[0] == update_id:
+                return
+
+            with ThreadPoolExecutor(max_workers=BROWSE_WORKERS) as pool:
+                # the first page tells the container's update id and size
+                first = {c: pool.submit(self._browse_page, music_library, c, 0)
+                         for c in CONTEXTS}
+                first = {c: f.result() for c, f in first.items()}
+                changed = [c for c in CONTEXTS
+                           if c not in self._entries or not first[c].update_id or
+                           synced.get(c) != (str(first[c].update_id), first[c].total_matches)]
+                self._progress = (0, sum(first[c].total_matches for c in changed))
+                self._changed()
+                for context in changed:
+                    self._sync_context(db, pool, music_library, context, first[context])
+
+            db.execute('INSERT OR REPLACE INTO synced VALUES (?, ?, ?)',
+                       (SYSTEM_ID, update_id, None))
+            db.commit()
+        finally:
+            db.close()
+
+    def _sync_context(self, db, pool, music_library, context, first):
+        """
+        replace the items of context, pages are written in order while up
+        to `BROWSE_AHEAD` of the next ones are fetched. The index is read
+        back from sqlite in sort order, only one page at a time is held
+        as python objects
+        """
+        db.execute('DELETE FROM items WHERE context = ?', (context,))
+        starts = iter(range(BROWSE_PAGE, first.total_matches, BROWSE_PAGE))
+        pending = deque()
+        page = first
+        while page is not None:
+            while len(pending) < BROWSE_AHEAD:
+                start = next(starts, None)
+                if start is None:
+                    break
+                pending.append(pool.submit(self._browse_page, music_library, context, start))
+            items = self._rows(context, page)
+            db.executemany('INSERT INTO items VALUES (?, ?, ?, ?, ?)',
+                           ((context,) + item for item in items))
+            fetched, total = self._progress
+            self._progress = (fetched + len(items), total)
+            self._changed()
+            page = pending.popleft().result() if pending else None
+        db.execute('INSERT OR REPLACE INTO synced VALUES (?, ?, ?)',
+                   (context, str(first.update_id), first.total_matches))
+        db.commit()
+
+        entries = dict(self._entries)
+        entries[context] = self._read(db, context)
+        self._set_entries(entries)
+        self._changed(context)
+
+    def _browse_page(self, music_library, context, start):
+        return music_library.get_music_library_information(
+            context, start=start, max_items=BROWSE_PAGE)
+
+    def _rows(self, context, page):
+        rows = []
+        for i in page:
+            art = getattr(i, 'album_art_uri', None) if context == 'albums' else None
+            rows.append((i.title, i.get_uri(), getattr(i, 'creator', None), art))
+        return rows
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from PIL import Image, ImageDraw, ImageFont
+import math
 import os
 import sys
 import time
@@ -10,16 +11,20 @@ from collections import defaultdict
 from timeit import default_timer as timer
 import gettext
 
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from artwork import ArtworkCache
+from render import RenderCache, getsize
+from search import SearchWorker
+from startup import Startup
 
-SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
-translate = gettext.translation('base', os.path.join(SCRIPT_DIR, 'locales'))
-_ = translate.gettext
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 NUM_ROWS = 7
-# found here: https://www.dafont.com/bitmap.php
-FONT = ImageFont.truetype(f'{SCRIPT_DIR}/minecraftia.ttf', 8)
-FONT_SMALL = ImageFont.truetype(f'{SCRIPT_DIR}/minecraftia.ttf', 6)
+# loaded by load_fonts(), found here: https://www.dafont.com/bitmap.php
+FONT = None
+FONT_SMALL = None
 COLOR_HIGHLIGHT = (210, 0, 125)
 COLOR_GREY = (80, 80, 80)
 COLOR_WHITE = (255, 255, 255)
@@ -31,8 +36,28 @@ PADDING = 10
 
 KEYPRESS_TIMEOUT = 2
 
+# never redraw more often than this (seconds), the panel can't show
+# more frames anyway
+MIN_FRAME_INTERVAL = 1 / 30
+
 IDLE_SLEEP_TIMEOUT = 30
 
+# the expected result of a command is shown until the speaker confirms
+# it, or for at most this many seconds
+PREDICTION_TIMEOUT = 5
+
+# album art next to the search results (selected album) and in the now
+# playing view, pixels
+ALBUM_ART_SIZE = 32
+NOW_PLAYING_ART_SIZE = 64
+
+# the selected row scrolls if its title is too long: after this many
+# seconds, with this many pixels per second and a gap between the end
+# and the start of the title
+MARQUEE_DELAY = 1.5
+MARQUEE_SPEED = 20
+MARQUEE_GAP = 30
+
 CONTEXTS = [dict(id='albums', name='album'),
             dict(id='tracks', name='song'),
             dict(id='artists', name='artist'),
@@ -40,6 +65,42 @@ CONTEXTS = [dict(id='albums', name='album'),
             ]
 
 
+_translation = None
+
+
+def _(message):
+    """
+    translate message, translations are only loaded when first needed
+    """
+    global _translation
+    if _translation is None:
+        _translation = gettext.translation('base', os.path.join(SCRIPT_DIR, 'locales'),
+                                           fallback=True)
+    return _translation.gettext(message)
+
+
+def load_fonts():
+    global FONT, FONT_SMALL
+    if FONT is None:
+        FONT = ImageFont.truetype(f'{SCRIPT_DIR}/minecraftia.ttf', 8)
+        FONT_SMALL = ImageFont.truetype(f'{SCRIPT_DIR}/minecraftia.ttf', 6)
+
+
+def show_splash(display):
+    """
+    first frame shown while everything else is still loading, only uses
+    PIL's builtin font
+    """
+    image = Image.new('RGB', (display.width, display.height))
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    text = 'sonos'
+    w, h = font.getsize(text)
+    draw.text(((display.width - w) / 2, (display.height - h) / 2), text,
+              font=font, fill=COLOR_HIGHLIGHT)
+    display.draw(image)
+
+
 class Status():
     def __init__(self):
         self.entered = ''
@@ -47,14 +108,17 @@ class Status():
         self.offset = 0
         self.speaker = 0
         self.context = 0
+        # 'search' or 'now_playing'
+        self.view = 'search'
         self._redraw_screen = False
         self._search_sonos = False
         self._refetch_volume = False
+        self._refetch_speakers = False
 
     def __setattr__(self, name, value):
         if name in ['entered', 'offset', 'context']:
             self._search_sonos = True
-        if name == '_refetch_volume' or not name.startswith('_'):
+        if name in ['_refetch_volume', '_refetch_speakers'] or not name.startswith('_'):
             self._redraw_screen = True
         super(Status, self).__setattr__(name, value)
 
@@ -85,6 +149,15 @@ class Status():
             self._refetch_volume = False
         return res
 
+    def should_refetch_speakers(self, reset=True):
+        """
+        did the speakers change so the list should be refetched?
+        """
+        res = self._refetch_speakers
+        if reset:
+            self._refetch_speakers = False
+        return res
+
     def row_up(self):
         if self.row == 0:
             if self.offset > 0:
@@ -103,6 +176,7 @@ class Status():
 class Controller():
     def __init__(self, keyboard, display, sonos, debug=False):
         self.line_height = 10
+        load_fonts()
 
         self.keyboard = keyboard
         self.display = display
@@ -110,10 +184,23 @@ class Controller():
         self.debug = debug
         self.image = Image.new('RGB', (display.width, display.height))
         self.draw = ImageDraw.Draw(self.image)
+        self.render = RenderCache()
         self.speakers = self.sonos.speakers()
+        self.speaker_status = []
+        # speaker number -> (expected SpeakerState, when it was predicted)
+        self.predicted = {}
         self.status = Status()
         self.last_drawn = defaultdict(list)
+        self.dirty = []
         self.count_idle = 0
+        self.items = []
+        self.started = False
+        self.searcher = SearchWorker(self.sonos, debug=debug, on_result=self.wake)
+        self.artwork = ArtworkCache(on_ready=self.on_artwork)
+        self.now_playing = None
+        # (row, text, since when selected) if the selected row scrolls
+        self.marquee = None
+        self.sonos.add_listener(self.on_speaker_change)
 
     def dialogue(self, options):
         DIAG_PADDING = 5
@@ -122,9 +209,9 @@ class Controller():
         image_dialogue = self.image.copy()
         draw_dialogue = ImageDraw.Draw(image_dialogue)
         while True:
-            _, h = FONT.getsize('E')
+            _, h = getsize('E', FONT)
             height = len(options) * h + (DIAG_PADDING * (len(options)))
-            width = max(FONT.getsize(o)[0] for o in options) + 2*DIAG_PADDING
+            width = max(getsize(o, FONT)[0] for o in options) + 2*DIAG_PADDING
             x = (self.display.width - width)/2
             y = (self.display.height - height)/2
             draw_dialogue.rectangle(
@@ -133,12 +220,12 @@ class Controller():
                 if i == chosen:
                     draw_dialogue.rectangle(
                         (x+1, y+1, x+width-1, y+h+DIAG_PADDING), fill=COLOR_HIGHLIGHT)
-                    col = COLOR_BLACK
+                    col, bg = COLOR_BLACK, COLOR_HIGHLIGHT
                 else:
-                    col = COLOR_WHITE
+                    col, bg = COLOR_WHITE, COLOR_GREY
 
-                draw_dialogue.text(
-                    (x+DIAG_PADDING, y+DIAG_PADDING), o, font=FONT, fill=col)
+                self.render.paste(image_dialogue, (x+DIAG_PADDING, y+DIAG_PADDING), o,
+                                  FONT, col, bg, height=h)
                 y += h + DIAG_PADDING - 1
             self.display.draw(image_dialogue)
             c = next(inp)
@@ -158,6 +245,84 @@ class Controller():
             else:
                 return None
 
+    def on_speaker_change(self, kind):
+        """
+        called by sonos (from a background thread) when a speaker changed
+        """
+        if kind == 'speakers':
+            self.status._refetch_speakers = True
+            self.predicted = {}
+        elif kind == 'failed':
+            # show the real state again
+            self.predicted = {}
+        elif kind == 'library':
+            # the results on screen might be outdated
+            self.searcher.invalidate()
+            self.status._search_sonos = True
+        elif kind in ('library_progress', 'art'):
+            # 'art': the daemon client got the album art url of a result
+            self.status._redraw_screen = True
+        if kind not in ('library', 'library_progress', 'art'):
+            self.status._refetch_volume = True
+        self.wake()
+
+    def on_artwork(self, uri):
+        """
+        called by the artwork cache (from a background thread) when a
+        thumbnail was loaded
+        """
+        self.status._redraw_screen = True
+        self.wake()
+
+    def wake(self):
+        """
+        let the loop handle what changed in the background right away
+        instead of after its timeout. Can be called from any thread
+        """
+        self.keyboard.wake()
+
+    def predict(self, kind, arg=1):
+        """
+        show the expected result of a command (see `SpeakerState.apply()`)
+        on the selected speaker right away, until the speaker confirms it
+        """
+        speaker = self.status.speaker
+        if speaker in self.predicted:
+            state = self.predicted[speaker][0]
+        else:
+            real = self.sonos.state(speaker)
+            if not real.complete():
+                # nothing known to predict from
+                self.status._refetch_volume = True
+                return
+            state = real.copy()
+        state.apply(kind, arg)
+        self.predicted[speaker] = (state, timer())
+        self.status._refetch_volume = True
+
+    def fetch_states(self):
+        """
+        status of the selected and all other speakers, predictions the
+        speakers confirmed or which timed out are dropped
+        """
+        predicted = dict(self.predicted)
+        for speaker, (state, since) in list(predicted.items()):
+            if (speaker >= len(self.speakers) or self.sonos.state(speaker).same(state)
+                    or timer() - since > PREDICTION_TIMEOUT):
+                del predicted[speaker]
+        self.predicted = predicted
+
+        self.speaker_status = self.sonos.speaker_status()
+        for speaker, (state, _) in predicted.items():
+            if speaker < len(self.speaker_status):
+                self.speaker_status[speaker] = state.as_short_string()
+        if self.status.speaker in predicted:
+            self.vol_play = predicted[self.status.speaker][0].as_string()
+        else:
+            self.vol_play = self.sonos.volume_play_as_string(
+                self.status.speaker, debug=self.debug)
+        self.now_playing = self.sonos.now_playing(self.status.speaker)
+
     def should_redraw(self, _id, *data):
         """
         see if something in this area has changed so self.draw.* should
@@ -170,104 +335,248 @@ class Controller():
         self.last_drawn[_id] = data
         return res
 
+    def mark_dirty(self, x0, y0, x1, y1):
+        """
+        remember that this area (same coordinates as self.draw.rectangle)
+        changed so only it needs to be sent to the display
+        """
+        box = (max(0, math.floor(x0)), max(0, math.floor(y0)),
+               min(self.display.width, math.ceil(x1) + 1),
+               min(self.display.height, math.ceil(y1) + 1))
+        if box[0] < box[2] and box[1] < box[3]:
+            self.dirty.append(box)
+
     def refresh(self):
-        start = timer()
-        if self.debug:
-            print()
+        # the volume and play/pause symbol take the right end of the bar
+        vol_width = getsize(self.vol_play, FONT)[0]
+        bar_end = self.display.width - vol_width*1.5
 
         # display speakers
-        if self.should_redraw('speakers', self.speakers, self.status.speaker):
-            start = timer()
-            x = PADDING
-            for i, speaker in enumerate(self.speakers):
-                text_width, _ = FONT.getsize(speaker)
-                if i == self.status.speaker:
+        if self.should_redraw('speakers', self.speakers, self.speaker_status, self.status.speaker,
+                              bar_end):
+            with metrics.span('render.speakers'):
+                # speakers might have been removed, clear the whole bar
+                self.draw.rectangle((0, 0, self.display.width, self.line_height), fill=COLOR_BLACK)
+                self.mark_dirty(0, 0, self.display.width, self.line_height)
+                self.last_drawn['volume'] = []
+                x = PADDING
+                for i, speaker in enumerate(self.speakers):
+                    text_width, _ = getsize(speaker, FONT)
+                    if i == self.status.speaker:
+                        color_text, color_box = COLOR_BLACK, COLOR_HIGHLIGHT
+                    else:
+                        color_text, color_box = COLOR_WHITE, COLOR_BLACK
                     self.draw.rectangle((x-(PADDING/2), 0, x+text_width, self.line_height),
-                                        fill=COLOR_HIGHLIGHT)
-                    self.draw.text((x, 0), speaker, font=FONT, fill=(0, 0, 0))
-                else:
-                    self.draw.rectangle((x-(PADDING/2), 0, x+text_width, self.line_height),
-                                        fill=COLOR_BLACK)
-                    self.draw.text((x, 0), speaker, font=FONT)
-                x += text_width + PADDING
-            if self.debug:
-                print(f'draw speakers: {timer() - start:.6f}')
+                                        fill=color_box)
+                    self.render.paste(self.image, (x, 0), speaker, FONT, color_text, color_box,
+                                      height=self.line_height+1)
+                    x += text_width + PADDING
+                    # compact play/volume indicator of the other speakers (the
+                    # selected one's is the volume on the right), without the
+                    # volume or not at all if it does not fit before it
+                    if i == self.status.speaker or i >= len(self.speaker_status):
+                        continue
+                    indicator = self.speaker_status[i]
+                    for indicator in (indicator, indicator.rstrip('0123456789')):
+                        width = getsize(indicator, FONT_SMALL)[0] if indicator else 0
+                        if indicator and x-PADDING/2+2+width <= bar_end:
+                            self.render.paste(self.image, (x-PADDING/2+2, 2), indicator, FONT_SMALL,
+                                              COLOR_GREY, COLOR_BLACK, height=self.line_height-1)
+                            x += width + PADDING/2
+                            break
 
         # display volume and play/pause symbol
         if self.should_redraw('volume', self.vol_play):
-            start = timer()
-            text_width, _ = FONT.getsize(self.vol_play)
-            x = self.display.width-(text_width*1.5)
-            self.draw.rectangle(
-                (x, 0, x+text_width*1.5, self.line_height), fill=COLOR_BLACK)
-            self.draw.text((self.display.width-text_width, 0), self.vol_play,
-                           font=FONT, fill=(99, 99, 99))
-            if self.debug:
-                print(f'draw volume: {timer() - start:.6f}')
+            with metrics.span('render.volume'):
+                x = bar_end
+                self.draw.rectangle(
+                    (x, 0, self.display.width, self.line_height), fill=COLOR_BLACK)
+                self.mark_dirty(x, 0, self.display.width, self.line_height)
+                self.render.paste(self.image, (self.display.width-vol_width, 0), self.vol_play,
+                                  FONT, (99, 99, 99), COLOR_BLACK, height=self.line_height+1)
+
+        # everything between the speaker bar and the buttons changes
+        # when switching views
+        if self.should_redraw('view', self.status.view):
+            self.draw.rectangle((0, self.line_height + 1, self.display.width, 108),
+                                fill=COLOR_BLACK)
+            self.mark_dirty(0, self.line_height + 1, self.display.width, 108)
+            for key in list(self.last_drawn):
+                if key not in ('view', 'speakers', 'volume', 'contexts', 'sync'):
+                    del self.last_drawn[key]
+        if self.status.view == 'now_playing':
+            self.refresh_now_playing()
+        else:
+            self.refresh_search()
+
+        # display contexts (f1, f2, …)
+        if self.should_redraw('contexts', self.status.context, self.status.view):
+            with metrics.span('render.contexts'):
+                x = PADDING
+                width = 25
+                if self.status.view == 'now_playing':
+                    selected = len(CONTEXTS)
+                else:
+                    selected = self.status.context
+                for i, txt in enumerate([c['name'] for c in CONTEXTS] + ['now']):
+                    f = f'F{i+1}'
+                    if i == selected:
+                        color_text = (0, 0, 0)
+                        color_box = COLOR_WHITE
+                    else:
+                        color_text = COLOR_WHITE
+                        color_box = COLOR_GREY
+                    text_width, _ = getsize(txt, FONT)
+                    padding = (width-text_width)/2
+
+                    def render_button(draw):
+                        draw.text((9, 1), f, font=FONT_SMALL, fill=color_text)
+                        draw.text((3+padding, 7), txt, font=FONT_SMALL, fill=color_text)
+                    button = self.render.get(('context', f, txt, color_text, color_box),
+                                             (width+1, 16), color_box, render_button)
+                    self.image.paste(button, (x, 110))
+                    x += width + 3
+                self.mark_dirty(PADDING, 110, x, 125)
+
+        # progress of the library sync, a line below the contexts
+        progress = self.sonos.library_progress()
+        bar = None if progress is None else round(progress * self.display.width)
+        if self.should_redraw('sync', bar):
+            y = self.display.height - 2
+            self.draw.rectangle((0, y, self.display.width, y + 1), fill=COLOR_BLACK)
+            if bar is not None:
+                self.draw.rectangle((0, y, self.display.width, y + 1), fill=COLOR_GREY)
+                if bar > 0:
+                    self.draw.rectangle((0, y, bar - 1, y + 1), fill=COLOR_HIGHLIGHT)
+            self.mark_dirty(0, y, self.display.width, y + 1)
+
+        if not self.dirty:
+            return
+        with metrics.span('display.flush'):
+            self.display.draw(self.image, self.dirty)
+        metrics.count('display.frames')
+        metrics.count('display.pixels', sum((x1-x0)*(y1-y0) for x0, y0, x1, y1 in self.dirty))
+        self.dirty = []
+
+    def refresh_search(self):
+        # album art of the selected album, on top of the first rows
+        art_uri = self.selected_art()
+        art = self.artwork.get(art_uri, ALBUM_ART_SIZE)
+        art_x, art_y = self.display.width - ALBUM_ART_SIZE - 2, 20
+        covered = False
+        if self.should_redraw('art', art_uri, art is None):
+            # repaint the rows below the old art
+            for line_no in range(NUM_ROWS):
+                if 20 + line_no*self.line_height < art_y + ALBUM_ART_SIZE:
+                    self.last_drawn.pop(f'results_line_{line_no}', None)
 
         # display search results
-        start = timer()
-        line_no = 0
-        for line_no, line_str in enumerate([i[0] for i in self.items[:NUM_ROWS]]):
-            if self.should_redraw(f'results_line_{line_no}', line_str, line_no == self.status.row):
+        with metrics.span('render.results'):
+            line_no = 0
+            if self.status.row >= len(self.items):
+                self.marquee = None
+            for line_no, line_str in enumerate([i[0] for i in self.items[:NUM_ROWS]]):
                 x, y = PADDING, 20 + line_no*self.line_height
+                if art is not None and y < art_y + ALBUM_ART_SIZE:
+                    width = art_x - x
+                else:
+                    width = self.display.width - x
+                offset = 0
                 if line_no == self.status.row:
+                    offset = self.marquee_offset(line_no, line_str, width)
+                if self.should_redraw(f'results_line_{line_no}', line_str, line_no == self.status.row,
+                                      offset):
+                    if line_no == self.status.row:
+                        color_text, color_box = COLOR_BLACK, COLOR_HIGHLIGHT
+                    else:
+                        color_text, color_box = COLOR_WHITE, COLOR_BLACK
                     self.draw.rectangle(
-                        (x-(PADDING/2), y, x+self.display.width, y+self.line_height), fill=COLOR_HIGHLIGHT)
-                    self.draw.text((x, y), line_str, font=FONT, fill=(0, 0, 0))
-                else:
+                        (x-(PADDING/2), y, x+self.display.width, y+self.line_height), fill=color_box)
+                    if offset:
+                        self.render.paste_window(self.image, (x, y), line_str, FONT, color_text,
+                                                 color_box, width, offset, MARQUEE_GAP,
+                                                 height=self.line_height+1)
+                    else:
+                        self.render.paste(self.image, (x, y), line_str, FONT, color_text, color_box,
+                                          height=self.line_height+1)
+                    self.mark_dirty(x-(PADDING/2), y, x+self.display.width, y+self.line_height)
+                    covered = covered or y < art_y + ALBUM_ART_SIZE
+            # draw remaining lines black
+            for line_no2 in range(line_no + 1, NUM_ROWS):
+                if self.should_redraw(f'results_line_{line_no2}', ''):
+                    x, y = PADDING, 20 + line_no2*self.line_height
                     self.draw.rectangle(
                         (x-(PADDING/2), y, x+self.display.width, y+self.line_height), fill=COLOR_BLACK)
-                    self.draw.text((x, y), line_str, font=FONT)
-        # draw remaining lines black
-        for line_no2 in range(line_no + 1, NUM_ROWS):
-            if self.should_redraw(f'results_line_{line_no2}', ''):
-                x, y = PADDING, 20 + line_no2*self.line_height
-                self.draw.rectangle(
-                    (x-(PADDING/2), y, x+self.display.width, y+self.line_height), fill=COLOR_BLACK)
-        if self.debug:
-            print(f'draw results: {timer() - start:.6f}')
+                    self.mark_dirty(x-(PADDING/2), y, x+self.display.width, y+self.line_height)
+                    covered = covered or y < art_y + ALBUM_ART_SIZE
+            if covered and art is not None:
+                self.image.paste(art, (art_x, art_y))
+                self.mark_dirty(art_x, art_y, art_x + ALBUM_ART_SIZE, art_y + ALBUM_ART_SIZE)
 
         # display enter area
         if self.should_redraw('enter', self.status.entered, self.status.context):
-            start = timer()
-            x, y = 10, 95
-            self.draw.rectangle(
-                (x, y, x+self.display.width, y+self.line_height), fill=COLOR_BLACK)
-            if self.status.context != 3:
-                self.draw.text((10, 95), f"> {self.status.entered}", font=FONT)
-            if self.debug:
-                print(f'draw search text: {timer() - start:.6f}')
+            with metrics.span('render.enter'):
+                x, y = 10, 95
+                self.draw.rectangle(
+                    (x, y, x+self.display.width, y+self.line_height), fill=COLOR_BLACK)
+                self.mark_dirty(x, y, x+self.display.width, y+self.line_height)
+                self.render.paste(self.image, (10, 95), f"> {self.status.entered}", FONT,
+                                  COLOR_WHITE, COLOR_BLACK, height=self.line_height+1)
 
-        # display contexts (f1, f2, …)
-        if self.should_redraw('contexts', self.status.context):
-            start = timer()
-            x = PADDING
-            for i, c in enumerate(CONTEXTS):
-                f = f'F{i+1}'
-                txt = c['name']
-                if i == self.status.context:
-                    color_text = (0, 0, 0)
-                    color_box = COLOR_WHITE
-                else:
-                    color_text = COLOR_WHITE
-                    color_box = COLOR_GREY
-                width = 25
-                text_width, _ = FONT.getsize(txt)
-                padding = (width-text_width)/2
-                self.draw.rectangle((x, 110, x+width, 125), fill=color_box)
-                self.draw.text((x+9, 111), f, font=FONT_SMALL, fill=color_text)
-                self.draw.text((x+3+padding, 117), txt,
-                               font=FONT_SMALL, fill=color_text)
-                x += width + 3
-            if self.debug:
-                print(f'draw contexts: {timer() - start:.6f}')
-
-        if self.debug:
-            start = timer()
-        self.display.draw(self.image)
-        if self.debug:
-            print(f'display: {timer() - start:.4f}')
+    def marquee_offset(self, row, text, width):
+        """
+        how many pixels the text of the selected row is scrolled, 0 if it
+        fits into width
+        """
+        text_width, _ = getsize(text, FONT)
+        if text_width <= width:
+            self.marquee = None
+            return 0
+        if self.marquee is None or self.marquee[:2] != (row, text):
+            self.marquee = (row, text, timer())
+            return 0
+        elapsed = timer() - self.marquee[2] - MARQUEE_DELAY
+        if elapsed <= 0:
+            return 0
+        return int(elapsed * MARQUEE_SPEED) % (text_width + MARQUEE_GAP)
+
+    def selected_art(self):
+        """
+        album art url of the selected album, None if not in the album
+        search or unknown
+        """
+        if CONTEXTS[self.status.context]['id'] != 'albums' or self.status.row >= len(self.items):
+            return None
+        return self.sonos.album_art('albums', self.items[self.status.row][1])
+
+    def refresh_now_playing(self):
+        """
+        album art with artist and album next to it, title below
+        """
+        track = self.now_playing
+        art = self.artwork.get(track[3] if track else None, NOW_PLAYING_ART_SIZE)
+        if not self.should_redraw('now_playing', track, art is None):
+            return
+        with metrics.span('render.now_playing'):
+            x, y = PADDING, 20
+            self.draw.rectangle((0, y, self.display.width, 108), fill=COLOR_BLACK)
+            self.mark_dirty(0, y, self.display.width, 108)
+            if track is None:
+                self.render.paste(self.image, (x, y), _('nothing playing'), FONT, COLOR_GREY,
+                                  COLOR_BLACK, height=self.line_height+1)
+                return
+            title, artist, album, _art = track
+            if art is not None:
+                self.image.paste(art, (x, y))
+            else:
+                self.draw.rectangle((x, y, x+NOW_PLAYING_ART_SIZE-1, y+NOW_PLAYING_ART_SIZE-1),
+                                    outline=COLOR_GREY)
+            for i, text in enumerate(t for t in (artist, album) if t):
+                self.render.paste(self.image, (x+NOW_PLAYING_ART_SIZE+PADDING/2, y+i*self.line_height),
+                                  text, FONT, COLOR_WHITE if i == 0 else COLOR_GREY, COLOR_BLACK,
+                                  height=self.line_height+1)
+            self.render.paste(self.image, (x, y+NOW_PLAYING_ART_SIZE+4), title or '', FONT,
+                              COLOR_HIGHLIGHT, COLOR_BLACK, height=self.line_height+1)
 
     def handle_keypress(self, c):
         if c == 'KEY_BACKSPACE':
@@ -305,13 +614,13 @@ class Controller():
             self.status._refetch_volume = True
         elif c == 'KEY_PLAYPAUSE':
             self.sonos.play_pause(self.status.speaker)
-            self.status._refetch_volume = True
+            self.predict('play_pause')
         elif c == 'KEY_VOLUMEUP':
             self.sonos.change_volume(self.status.speaker, 2)
-            self.status._refetch_volume = True
+            self.predict('volume', 2)
         elif c == 'KEY_VOLUMEDOWN':
             self.sonos.change_volume(self.status.speaker, -2)
-            self.status._refetch_volume = True
+            self.predict('volume', -2)
         elif c == 'KEY_NEXTSONG':
             self.sonos.next(self.status.speaker)
         elif c == 'KEY_PREVIOUSSONG':
@@ -320,17 +629,21 @@ class Controller():
             self.sonos.reindex()
         elif c == 'KEY_CONFIG':
             self.sonos.cycle_repeat(self.status.speaker)
-            self.status._refetch_volume = True
+            self.predict('repeat')
         elif c == 'KEY_F1':
             self.status.context = 0
+            self.status.view = 'search'
         elif c == 'KEY_F2':
             self.status.context = 1
+            self.status.view = 'search'
         elif c == 'KEY_F3':
             self.status.context = 2
+            self.status.view = 'search'
         elif c == 'KEY_F4':
             self.status.context = 3
+            self.status.view = 'search'
         elif c == 'KEY_F5':
-            self.status.context = 4
+            self.status.view = 'search' if self.status.view == 'now_playing' else 'now_playing'
         elif c is not None and len(c) == 1:
             self.status.entered += c
             self.status.row = 0
@@ -341,46 +654,110 @@ class Controller():
             self.count_idle += 1
             if self.count_idle * KEYPRESS_TIMEOUT >= IDLE_SLEEP_TIMEOUT:
                 self.sleep()
+                return
+            if not self.sonos.subscribed():
+                # no events, poll for changes done at the speakers
+                self.sonos.refresh_states()
             self.status._refetch_volume = True
         else:
             self.count_idle = 0
 
     def sleep(self):
         """
-        turn screen to black and wait for keypress before waking up
+        turn screen and backlight off, stop events and polling and wait
+        for a keypress (which is dropped) before waking up. While asleep
+        only the input thread waits on the input devices
         """
+        metrics.count('power.sleep')
         self.display.display_off()
+        self.sonos.pause()
         gen = self.keyboard.getch_generator(debug=self.debug)
         next(gen)
         self.display.display_on()
+        # the last frame right away, the speakers catch up in the background
+        self.display.draw(self.image)
+        self.sonos.resume()
+        self.count_idle = 0
+        self.status._refetch_volume = True
+
+    def start(self):
+        """
+        draw the first frame and start the initial search
+        """
+        self.fetch_states()
+        self.searcher.submit(CONTEXTS[self.status.context]['id'], '', max_items=NUM_ROWS)
+        self.refresh()
+        self.started = True
 
     def loop(self):
         """
-        k: keyboard module/object, needs to provide `getch_generator()`
+        k: keyboard module/object, needs to provide `getch_batches()`, `getch_generator()`
+           and `wake()`
         display: display module/objects, needs to provide `image(pil_image)`, `width` and `height`
         s: instance of sonos, needs to provide a dozen functions, see sonos module
         """
-
-        self.vol_play = self.sonos.volume_play_as_string(self.status.speaker)
-        self.items = self.sonos.search(CONTEXTS[self.status.context]['id'], '',
-                                       max_items=NUM_ROWS, debug=self.debug)
-        self.refresh()
-
-        for c in self.keyboard.getch_generator(debug=self.debug, timeout=KEYPRESS_TIMEOUT):
+        if not self.started:
+            self.start()
+
+        last_tick = timer()
+        last_frame = 0
+
+        def timeout():
+            # background results wake the loop up (see `wake()`), it only
+            # wakes up by itself for the next frame of the scrolling row,
+            # a frame held back by MIN_FRAME_INTERVAL or the idle tick
+            if self.status.should_redraw_screen(reset=False) or (
+                    self.marquee is not None and self.status.view == 'search'):
+                return max(0, last_frame + MIN_FRAME_INTERVAL - timer())
+            return max(0, last_tick + KEYPRESS_TIMEOUT - timer())
+
+        for keys in self.keyboard.getch_batches(debug=self.debug, timeout=timeout):
             try:
-                self.handle_keypress(c)
+                # apply all keys pressed in the meantime, then search and
+                # redraw only once for the final state
+                if keys:
+                    last_tick = timer()
+                    metrics.observe('input.batch_size', len(keys))
+                    with metrics.span('input.keypress'):
+                        for c in keys:
+                            self.handle_keypress(c)
+                elif timer() - last_tick >= KEYPRESS_TIMEOUT:
+                    # only pass on a timeout if there was no keypress for KEYPRESS_TIMEOUT
+                    last_tick = timer()
+                    self.handle_keypress(None)
 
                 if self.status.should_search_sonos():
-                    self.items = self.sonos.search(CONTEXTS[self.status.context]['id'],
-                                                   self.status.entered, max_items=NUM_ROWS,
-                                                   offset=self.status.offset, debug=self.debug)
+                    self.searcher.submit(CONTEXTS[self.status.context]['id'],
+                                         self.status.entered, max_items=NUM_ROWS,
+                                         offset=self.status.offset)
+
+                items = self.searcher.result()
+                if items is not None:
+                    self.items = items
+                    self.status._redraw_screen = True
+
+                if self.status.should_refetch_speakers():
+                    # keep the selected speaker selected
+                    selected = self.speakers[self.status.speaker]
+                    self.speakers = self.sonos.speakers()
+                    if selected in self.speakers:
+                        self.status.speaker = self.speakers.index(selected)
+                    else:
+                        self.status.speaker = 0
 
                 if self.status.should_refetch_volume():
-                    self.vol_play = self.sonos.volume_play_as_string(
-                        self.status.speaker, debug=self.debug)
+                    self.fetch_states()
+
+                if self.marquee is not None and self.status.view == 'search':
+                    # next step of the scrolling row, refresh() only
+                    # redraws that row
+                    self.status._redraw_screen = True
 
-                if self.status.should_redraw_screen():
+                if (self.status.should_redraw_screen(reset=False) and
+                        timer() - last_frame >= MIN_FRAME_INTERVAL):
+                    self.status.should_redraw_screen()
                     self.refresh()
+                    last_frame = timer()
             except Exception as e:
                 f = open('/tmp/sonos_lcd.log', 'a+')
                 f.write(str(e) + "\n")
@@ -396,11 +773,57 @@ def main_raspberry():
         DEBUG = True
     else:
         DEBUG = False
-    import screen
-    import keyboard
-    from sonos import Sonos
-    display = screen.Screen()
-    c = Controller(keyboard, display, Sonos(), debug=DEBUG)
+    if DEBUG or os.environ.get('SONOS_LCD_METRICS'):
+        metrics.enable()
+    metrics.install_signal_handler()
+    startup = Startup()
+
+    # get something on the screen as early as possible
+    with startup.phase('import screen'):
+        import screen
+    with startup.phase('init display'):
+        display = screen.Screen()
+    with startup.phase('splash'):
+        show_splash(display)
+    startup.frame_shown()
+
+    # load the heavy parts in parallel
+    def load_keyboard():
+        with startup.phase('keyboard'):
+            import keyboard
+            keyboard.open_devices()
+            return keyboard
+
+    def load_sonos():
+        address = os.environ.get('SONOS_LCD_DAEMON')
+        if address:
+            # speakers and library are shared with other controllers
+            with startup.phase('connect daemon'):
+                from daemon import SonosClient
+                return SonosClient(address)
+        with startup.phase('import soco'):
+            from sonos import Sonos
+        with startup.phase('init sonos'):
+            return Sonos()
+
+    def load_resources():
+        with startup.phase('fonts + translations'):
+            load_fonts()
+            _('replace')
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        keyboard = pool.submit(load_keyboard)
+        sonos = pool.submit(load_sonos)
+        resources = pool.submit(load_resources)
+        keyboard, sonos = keyboard.result(), sonos.result()
+        resources.result()
+
+    with startup.phase('first ui frame'):
+        c = Controller(keyboard, display, sonos, debug=DEBUG)
+        c.start()
+    startup.write()
+    if DEBUG:
+        print(startup.report())
     c.loop()
 
 
@@ -434,6 +857,8 @@ def main_development():
         sys.exit(1)
 
     from mock import Keyboard, Display
+    metrics.enable()
+    metrics.install_signal_handler()
     c = Controller(Keyboard(), Display(), s, debug=True)
     c.loop()
 
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+timing spans, counters and rolling histograms for the hot paths
+(rendering, display flushes, SOAP calls, search caches).
+
+usage:
+
+> import metrics
+> metrics.enable()
+> with metrics.span('render.results'):
+>     ...
+> metrics.count('search.window_hit')
+
+Disabled (the default) `span()` returns a shared no-op context manager
+and `count()` returns right away, so instrumentation can stay in the hot
+paths. `kill -USR1 <pid>` writes a report if `install_signal_handler()`
+was called
+"""
+
+import os
+import signal
+import sys
+import threading
+import time
+from collections import deque
+
+# how many of the latest values every histogram keeps
+HISTOGRAM_WINDOW = 1000
+
+METRICS_PATH = '/tmp/sonos_lcd_metrics.txt'
+
+_enabled = False
+_lock = threading.RLock()
+_counters = {}
+_histograms = {}
+
+
+class Histogram():
+    def __init__(self, window=HISTOGRAM_WINDOW, unit=''):
+        """
+        unit: 's' for timings (reported in ms), else values are reported
+              as they are
+        """
+        self.unit = unit
+        self.values = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.values.append(value)
+        self.count += 1
+        self.total += value
+
+    def percentile(self, p):
+        values = sorted(self.values)
+        if not values:
+            return 0
+        return values[int(round(p / 100 * (len(values) - 1)))]
+
+
+class _Span():
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start, unit='s')
+        return False
+
+
+class _NoSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def span(name):
+    """
+    context manager which records how long the block took (seconds)
+    in the histogram `name`
+    """
+    if not _enabled:
+        return _NO_SPAN
+    return _Span(name)
+
+
+def count(name, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def observe(name, value, unit=''):
+    """
+    add value to the rolling histogram `name`
+    """
+    if not _enabled:
+        return
+    with _lock:
+        h = _histograms.get(name)
+        if h is None:
+            h = _histograms[name] = Histogram(unit=unit)
+        h.add(value)
+
+
+def report():
+    """
+    return all counters and histograms as human readable text,
+    span timings are in milliseconds
+    """
+    lines = []
+    with _lock:
+        for name in sorted(_histograms):
+            h = _histograms[name]
+            scale, unit = (1000, 'ms') if h.unit == 's' else (1, h.unit)
+            lines.append(f'{name:24} n={h.count:6}  mean {scale * h.total / h.count:8.3f}{unit}  '
+                         f'p50 {scale * h.percentile(50):8.3f}{unit}  '
+                         f'p90 {scale * h.percentile(90):8.3f}{unit}  '
+                         f'max {scale * max(h.values):8.3f}{unit}')
+        for name in sorted(_counters):
+            lines.append(f'{name:24} {_counters[name]}')
+    return '\n'.join(lines) + '\n'
+
+
+def dump(path=None):
+    """
+    write `report()` to path, or to stderr if path is None
+    """
+    text = report()
+    if path is None:
+        sys.stderr.write(text)
+        return
+    with open(path, 'w') as f:
+        f.write(f'# pid {os.getpid()} {time.strftime("%Y-%m-%d %H:%M:%S")}\n')
+        f.write(text)
+
+
+def install_signal_handler(path=METRICS_PATH):
+    """
+    dump the report to path on SIGUSR1
+    """
+    signal.signal(signal.SIGUSR1, lambda signum, frame: dump(path))
@@ -3,10 +3,17 @@
 provide mock objects in order to develop locally
 """
 
-from PIL import Image, ImageTk, ImageFilter
+import os
+import random
+import threading
 import time
 import tty
+import select
 import sys
+from collections import deque
+
+from commands import CommandQueue
+from state import SpeakerState
 
 PADDING = 10
 
@@ -14,9 +21,22 @@ PADDING = 10
 class Keyboard:
     def __init__(self):
         tty.setcbreak(sys.stdin)
+        # written to by `wake()`
+        self._wakeup, self._wakeup_write = os.pipe()
+
+    def wake(self):
+        os.write(self._wakeup_write, b'.')
 
     def getch_generator(self, debug=False, timeout=None):
         while True:
+            if timeout is not None:
+                wait = timeout() if callable(timeout) else timeout
+                readable, _, _ = select.select([sys.stdin, self._wakeup], [], [], max(wait, 0))
+                if self._wakeup in readable:
+                    os.read(self._wakeup, 1024)
+                if sys.stdin not in readable:
+                    yield None
+                    continue
             c = sys.stdin.read(1)
 
             if ord(c) == 27:
@@ -57,13 +77,180 @@ class Keyboard:
             else:
                 yield c
 
+    def getch_batches(self, debug=False, timeout=None):
+        """
+        yield lists of all keys typed since the last batch
+        """
+        keys = self.getch_generator(debug, timeout if timeout is not None else 3600)
+        for key in keys:
+            if key is None:
+                if timeout is not None:
+                    yield []
+                continue
+            batch = [key]
+            while select.select([sys.stdin], [], [], 0)[0]:
+                batch.append(next(keys))
+            yield batch
+
+
+class ScriptedKeyboard:
+    """
+    replays a list of (delay in seconds, key) instead of reading a
+    keyboard, e.g. [(0.1, 'o'), (0.1, 'k'), (0.5, 'KEY_DOWN')]. Keys are
+    "pressed" at fixed times, if the consumer is slower they queue up
+    like in a real input device.
+    Records the time from pressing every key until the consumer asked for
+    the next input (i.e. was done handling it) in `latencies`
+    """
+
+    def __init__(self, script, settle=1.0):
+        self.script = script
+        self.settle = settle
+        self.latencies = []
+        self._wakeup = threading.Event()
+        # (time, key) not taken yet, shared by all generators so the
+        # script plays out once, whoever reads it (loop, dialogue, ..).
+        # The times are set when the first generator starts
+        self._pressed = None
+        self._end = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _start(self):
+        if self._pressed is not None:
+            return
+        self._pressed = deque()
+        t = time.perf_counter()
+        for delay, key in self.script:
+            t += delay
+            self._pressed.append((t, key))
+        self._end = t + self.settle
+
+    def _keys(self, timeout, single):
+        """
+        yield lists of the keys pressed by now (only the first one if
+        single), an empty list on timeout or `wake()`
+        """
+        self._start()
+        pressed = self._pressed
+        while True:
+            now = time.perf_counter()
+            batch = []
+            while pressed and pressed[0][0] <= now and not (single and batch):
+                batch.append(pressed.popleft())
+            if batch:
+                yield [key for _, key in batch]
+                done = time.perf_counter()
+                self.latencies.extend((key, done - t) for t, key in batch)
+                continue
+            if not pressed and now >= self._end:
+                return
+            deadline = pressed[0][0] if pressed else self._end
+            wait = timeout() if callable(timeout) else timeout
+            if wait is None or wait >= deadline - now:
+                if self._wakeup.wait(deadline - now):
+                    self._wakeup.clear()
+                    if wait is not None:
+                        yield []
+            else:
+                if self._wakeup.wait(max(wait, 0)):
+                    self._wakeup.clear()
+                yield []
+
+    def getch_batches(self, debug=False, timeout=None):
+        return self._keys(timeout, single=False)
+
+    def getch_generator(self, debug=False, timeout=None):
+        for keys in self._keys(timeout, single=True):
+            yield keys[0] if keys else None
+
+
+class EventSource:
+    """
+    stand-in for the UPnP event subscriptions: every `interval` seconds
+    someone changes the volume or pauses at one of the speakers
+    """
+
+    def __init__(self, speakers, callback, interval=5):
+        self.speakers = speakers
+        self.callback = callback
+        self.interval = interval
+        # cleared while paused, no events are sent then
+        self.running = threading.Event()
+        self.running.set()
+        if interval:
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def emit(self, speaker, **variables):
+        """
+        send an event with variables as soco would, e.g.
+        `emit('Weiss', volume={'Master': '20'})`
+        """
+        self.callback(speaker, variables)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.running.wait()
+            speaker = random.choice(self.speakers)
+            if random.random() < 0.5:
+                self.emit(speaker, volume={'Master': str(random.randint(0, 100))})
+            else:
+                self.emit(speaker, transport_state=random.choice(
+                    ['PLAYING', 'PAUSED_PLAYBACK']))
+
 
 class Sonos:
+    def __init__(self, event_interval=5):
+        self._states = {}
+        for name in self.speakers():
+            self._states[name] = SpeakerState()
+            self._states[name].update(dict(transport_state='PLAYING',
+                                           current_play_mode='NORMAL', volume='50'))
+        self._listeners = []
+        self.events = EventSource(self.speakers(), self._on_event, interval=event_interval)
+
+    def _on_event(self, speaker, variables):
+        if self._states[speaker].update(variables):
+            for callback in self._listeners:
+                callback('state')
+
     def speakers(self):
         return ['Schwarz', 'Weiss']
 
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def subscribed(self):
+        return self.events.running.is_set()
+
+    def pause(self):
+        self.events.running.clear()
+
+    def resume(self):
+        self.events.running.set()
+
+    def state(self, selected_speaker):
+        return self._states[self.speakers()[selected_speaker]]
+
+    def now_playing(self, selected_speaker):
+        return ('Paranoid Android', 'Radiohead', 'OK Computer', None)
+
+    def album_art(self, context, uri):
+        return None
+
     def volume_play_as_string(self, selected_speaker, debug=False):
-        return "> 50%"
+        return self._states[self.speakers()[selected_speaker]].as_string()
+
+    def speaker_status(self):
+        return [self._states[name].as_short_string() for name in self.speakers()]
+
+    def refresh_states(self, speaker_numbers=None):
+        pass
+
+    def library_progress(self):
+        return None
 
     def search(self, context, term, offset=0, max_items=7, debug=False):
         res = []
@@ -73,12 +260,108 @@ class Sonos:
         elif context == 'tracks':
             res = ['Hamba hamba', 'Everybody', 'Take Five', 'Paranoid Android']
 
-        return [(i, i) for i in res]
+        return [(i, i) for i in res][offset:offset + max_items]
 
     def play(self, speaker, uri):
         print(f'play {uri} on {speaker}')
 
 
+class SlowSonos(Sonos):
+    """
+    sonos with a library of `library_size` items per context where every
+    call to the "speaker" takes `latency` seconds
+    """
+
+    def __init__(self, library_size=10000, latency=0.05):
+        super().__init__(event_interval=0)
+        self.latency = latency
+        self.calls = 0
+        self._commands = CommandQueue(self._execute)
+        rnd = random.Random(42)
+        words = ['love', 'night', 'blue', 'computer', 'android', 'seasons', 'five',
+                 'destruction', 'generation', 'everybody', 'song', 'dance', 'heart']
+        self._library = {}
+        for context in ['albums', 'tracks', 'artists', 'radio_stations']:
+            titles = sorted(' '.join(rnd.choice(words) for _ in range(rnd.randint(1, 4))).title()
+                            for _ in range(library_size))
+            self._library[context] = [(t, f'x-file-cifs://nas/{context}/{i}')
+                                      for i, t in enumerate(titles)]
+
+    def _call(self):
+        self.calls += 1
+        time.sleep(self.latency)
+
+    def search(self, context, term, offset=0, max_items=7, debug=False):
+        self._call()
+        term = term.lower()
+        res = [i for i in self._library[context] if term in i[0].lower()]
+        return res[offset:offset + max_items]
+
+    def play(self, speaker, uri):
+        self._commands.put(speaker, 'play', uri)
+
+    def add_to_queue(self, speaker, uri):
+        self._commands.put(speaker, 'add_to_queue', uri)
+
+    def change_volume(self, speaker, diff):
+        self._commands.put(speaker, 'volume', diff)
+
+    def play_pause(self, speaker):
+        self._commands.put(speaker, 'play_pause', 1)
+
+    def cycle_repeat(self, speaker):
+        self._commands.put(speaker, 'repeat', 1)
+
+    def next(self, speaker):
+        self._commands.put(speaker, 'next')
+
+    def previous(self, speaker):
+        self._commands.put(speaker, 'previous')
+
+    def _execute(self, speaker, kind, arg):
+        """
+        like `sonos.Sonos._execute()`: one call per command, the speaker
+        confirms the change with an event
+        """
+        self._call()
+        if kind in ('volume', 'play_pause', 'repeat'):
+            name = self.speakers()[speaker]
+            state = self._states[name].copy()
+            state.apply(kind, arg)
+            self._on_event(name, dict(volume=state.volume, transport_state=state.transport_state,
+                                      current_play_mode=state.play_mode))
+
+    def reindex(self):
+        self._call()
+
+
+class HeadlessDisplay:
+    """
+    display which only keeps the last frame in memory and counts what
+    would have been sent to the panel
+    """
+    width = 160
+    height = 128
+
+    def __init__(self):
+        self.image = None
+        self.frames = 0
+        self.pixels = 0
+
+    def display_off(self):
+        pass
+
+    def display_on(self):
+        pass
+
+    def draw(self, image, boxes=None):
+        if boxes is None:
+            boxes = [(0, 0, self.width, self.height)]
+        self.frames += 1
+        self.pixels += sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in boxes)
+        self.image = image.copy()
+
+
 class Display:
     width = 160
     height = 128
@@ -98,7 +381,11 @@ class Display:
     def __del__(self):
         self._root.quit()
 
-    def draw(self, image):
+    def draw(self, image, boxes=None):
+        """
+        boxes are ignored, the whole image is redrawn in the tk window
+        """
+        from PIL import ImageTk
         img = ImageTk.PhotoImage(image)
         self._canvas.itemconfig(self._imgArea, image=img)
         self._root.update()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+cache of pre-rendered text strips. Rasterizing the TrueType font with
+FreeType is where most of the CPU time on the Pi Zero goes, with this
+redrawing a row is only an `Image.paste`
+"""
+
+from collections import OrderedDict
+from functools import lru_cache
+
+from PIL import Image, ImageDraw
+
+import metrics
+
+# upper limit of memory used by cached strips (RGB, 3 bytes per pixel)
+RENDER_CACHE_BYTES = 512 * 1024
+
+
+@lru_cache(maxsize=2048)
+def getsize(text, font):
+    """
+    cached version of `font.getsize(text)`
+    """
+    return font.getsize(text)
+
+
+class RenderCache():
+    def __init__(self, max_bytes=RENDER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._images = OrderedDict()
+
+    def get(self, key, size, background, render):
+        """
+        return the cached image for `key`. If it's not cached yet then an
+        image of `size` filled with `background` is created and painted
+        by `render(draw)`.
+        Least recently used images are evicted once the cache is over
+        `max_bytes`
+        """
+        img = self._images.get(key)
+        if img is not None:
+            self._images.move_to_end(key)
+            metrics.count('render_cache.hit')
+            return img
+
+        metrics.count('render_cache.miss')
+        img = Image.new('RGB', (max(1, int(size[0])), max(1, int(size[1]))), background)
+        render(ImageDraw.Draw(img))
+        self._images[key] = img
+        self.size += img.width * img.height * 3
+        while self.size > self.max_bytes and len(self._images) > 1:
+            _, old = self._images.popitem(last=False)
+            self.size -= old.width * old.height * 3
+        return img
+
+    def text(self, text, font, fill, background, height=None):
+        """
+        strip with `text` rendered on `background`.
+        height: cut off the strip (e.g. to the row height) so it does not
+                paint over whatever is below
+        """
+        width, text_height = getsize(text, font)
+        if height is None:
+            height = text_height
+        return self.get((text, font, fill, background, height), (width, height), background,
+                        lambda draw: draw.text((0, 0), text, font=font, fill=fill))
+
+    def paste(self, image, xy, text, font, fill, background, height=None):
+        """
+        like `ImageDraw.text(xy, text, font=font, fill=fill)` but on a
+        solid background and served from the cache
+        """
+        strip = self.text(text, font, fill, background, height)
+        image.paste(strip, (int(xy[0]), int(xy[1])))
+
+    def paste_window(self, image, xy, text, font, fill, background, width, offset, gap,
+                     height=None):
+        """
+        marquee: paste `width` pixels, starting at `offset`, of a strip
+        looping `text` with `gap` pixels in between. The strip is only
+        rendered once, every step of the animation is a crop and paste
+        """
+        text_width, text_height = getsize(text, font)
+        if height is None:
+            height = text_height
+
+        def render(draw):
+            draw.text((0, 0), text, font=font, fill=fill)
+            draw.text((text_width + gap, 0), text, font=font, fill=fill)
+        strip = self.get(('loop', text, font, fill, background, height, gap),
+                         (2 * text_width + gap, height), background, render)
+        offset %= text_width + gap
+        image.paste(strip.crop((offset, 0, offset + int(width), height)), (int(xy[0]), int(xy[1])))
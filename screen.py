@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import time
+
 import busio
 import digitalio
 from board import SCK, MOSI, CE0, D24, D25, D27
@@ -7,6 +9,20 @@ from board import SCK, MOSI, CE0, D24, D25, D27
 from adafruit_rgb_display import color565
 import adafruit_rgb_display.st7735 as st7735
 
+try:
+    from framebuffer import Framebuffer565
+except ImportError:
+    # without numpy adafruit_rgb_display converts every pixel in python
+    Framebuffer565 = None
+
+# ST7735 commands to put the panel to sleep, it keeps its RAM (the last
+# frame) and needs 120ms after waking up before taking commands
+SLPIN = 0x10
+SLPOUT = 0x11
+DISPOFF = 0x28
+DISPON = 0x29
+SLPOUT_DELAY = 0.12
+
 
 class Screen:
     def __init__(self):
@@ -16,22 +32,45 @@ class Screen:
         # Create the ST7735S display:
         width = 160
         height = 128
+        self.backlight = digitalio.DigitalInOut(D24)
         self.display = st7735.ST7735S(spi, cs=digitalio.DigitalInOut(CE0),
                                       dc=digitalio.DigitalInOut(D25),
                                       rst=digitalio.DigitalInOut(D27),
-                                      bl=digitalio.DigitalInOut(D24),
+                                      bl=self.backlight,
                                       width=width, height=height, x_offset=1, y_offset=2,
                                       )
 
         self.display.fill(color565(0, 0, 0))
         self.width = width
         self.height = height
+        self.framebuffer = Framebuffer565(width, height) if Framebuffer565 else None
 
     def display_off(self):
-        self.display.rst.switch_to_output(False)
+        """
+        backlight off and the panel to sleep mode
+        """
+        self.backlight.value = False
+        self.display.write(DISPOFF)
+        self.display.write(SLPIN)
 
     def display_on(self):
-        self.display.rst.switch_to_output(True)
+        self.display.write(SLPOUT)
+        time.sleep(SLPOUT_DELAY)
+        self.display.write(DISPON)
+        self.backlight.value = True
 
-    def draw(self, image):
-        self.display.image(image)
+    def draw(self, image, boxes=None):
+        """
+        boxes: list of (x0, y0, x1, y1) crop boxes of `image` which
+               changed, only those windows are sent over SPI.
+               If None then the whole image is sent
+        """
+        if self.framebuffer is not None:
+            for y0, y1, data in self.framebuffer.update(image, boxes):
+                self.display._block(0, y0, self.width - 1, y1 - 1, data)
+            return
+        if boxes is None:
+            self.display.image(image)
+            return
+        for box in boxes:
+            self.display.image(image.crop(box), x=box[0], y=box[1])
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+run searches against the sonos library in a background thread so
+typing never has to wait for a search to finish
+"""
+
+import threading
+
+import metrics
+
+# wait this many seconds after the last keypress before searching so a
+# burst of typed characters results in only one search
+SEARCH_DEBOUNCE = 0.15
+
+# results are fetched in windows of this many items so scrolling can be
+# answered from memory
+PAGE_WINDOW = 100
+
+
+class SearchWorker():
+    def __init__(self, sonos, debounce=SEARCH_DEBOUNCE, window=PAGE_WINDOW, debug=False,
+                 on_result=None):
+        """
+        on_result() is called (from the worker thread) when a result is
+        ready to be taken with `result()`
+        """
+        self.sonos = sonos
+        self.on_result = on_result
+        self.debounce = debounce
+        self.window = window
+        self.debug = debug
+        self._cond = threading.Condition()
+        self._generation = 0
+        self._pending = None
+        self._prefetch = None
+        self._result = None
+        # (context, term) the windows belong to and {window start: items}
+        self._key = None
+        self._windows = {}
+        # changed by `invalidate()`, fetches started before are dropped
+        self._epoch = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, context, term, offset=0, max_items=7):
+        """
+        queue a search, any search queued or running before is outdated
+        from now on and its result is dropped.
+        If the items are already in a fetched window then the result is
+        available right away
+        """
+        with self._cond:
+            self._generation += 1
+            if (context, term) != self._key:
+                self._key = (context, term)
+                self._windows = {}
+                self._prefetch = None
+            items = self._from_windows(offset, max_items)
+            if items is not None:
+                metrics.count('search.window_hit')
+                self._pending = None
+                self._result = items
+                self._queue_prefetch(offset + max_items)
+            else:
+                metrics.count('search.window_miss')
+                self._pending = (self._generation, (context, term, offset, max_items))
+            self._cond.notify()
+
+    def invalidate(self):
+        """
+        drop the fetched windows, e.g. because the library changed, so
+        the next `submit()` asks sonos again
+        """
+        with self._cond:
+            self._windows = {}
+            self._prefetch = None
+            self._epoch += 1
+
+    def result(self):
+        """
+        return the items of the latest search if it finished since the
+        last call, else None
+        """
+        with self._cond:
+            res = self._result
+            self._result = None
+        return res
+
+    def _window_starts(self, offset, max_items):
+        first = offset - offset % self.window
+        return range(first, offset + max(max_items, 1), self.window)
+
+    def _from_windows(self, offset, max_items):
+        items = []
+        for start in self._window_starts(offset, max_items):
+            window = self._windows.get(start)
+            if window is None:
+                return None
+            items.extend(window)
+            if len(window) < self.window:
+                # end of the list
+                break
+        first = offset - offset % self.window
+        return items[offset - first:offset - first + max_items]
+
+    def _queue_prefetch(self, end):
+        """
+        fetch the next window in the background once the cursor is in the
+        second half of the current one
+        """
+        start = end - end % self.window
+        current = self._windows.get(start)
+        if current is None or len(current) < self.window:
+            return
+        if end - start >= self.window / 2 and start + self.window not in self._windows:
+            self._prefetch = (self._key, start + self.window)
+
+    def _fetch(self, key, start):
+        context, term = key
+        with metrics.span('search.window_fetch'):
+            return self.sonos.search(context, term, offset=start,
+                                     max_items=self.window, debug=self.debug)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and self._prefetch is None:
+                    self._cond.wait()
+                if self._pending is not None:
+                    # debounce: wait until nothing new was submitted for a while
+                    while True:
+                        generation = self._generation
+                        self._cond.wait(self.debounce)
+                        if generation == self._generation:
+                            break
+                if self._pending is None and self._prefetch is None:
+                    # answered from the windows during the debounce
+                    continue
+                epoch = self._epoch
+                if self._pending is not None:
+                    generation, (context, term, offset, max_items) = self._pending
+                    self._pending = None
+                    key = (context, term)
+                    starts = [s for s in self._window_starts(offset, max_items)
+                              if s not in self._windows]
+                    if not starts:
+                        # filled by a prefetch in the meantime
+                        self._result = self._from_windows(offset, max_items)
+                        self._result_ready()
+                        continue
+                else:
+                    generation = None
+                    key, start = self._prefetch
+                    self._prefetch = None
+                    starts = [start]
+
+            windows = {}
+            try:
+                for start in starts:
+                    windows[start] = self._fetch(key, start)
+                    if len(windows[start]) < self.window:
+                        break
+            except Exception as e:
+                print(f'search {key[0]} "{key[1]}" failed: {e}')
+                continue
+
+            with self._cond:
+                if key != self._key or epoch != self._epoch:
+                    # user typed on or the library changed in the
+                    # meantime, result is outdated
+                    metrics.count('search.dropped')
+                    continue
+                self._windows.update(windows)
+                if generation == self._generation:
+                    self._result = self._from_windows(offset, max_items)
+                    self._queue_prefetch(offset + max_items)
+                    self._result_ready()
+
+    def _result_ready(self):
+        if self.on_result is not None:
+            self.on_result()
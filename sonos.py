@@ -1,8 +1,19 @@
 #!/usr/bin/env python
 
+import json
+import os
+import queue
+import threading
 import soco
+from concurrent.futures import ThreadPoolExecutor
 from timeit import default_timer as timer
 
+import connections
+import metrics
+from commands import CommandQueue
+from library import BROWSE_WORKERS, LibraryIndex
+from state import SpeakerState, next_play_mode
+
 TUNEIN_TEMPLATE = """
 <DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/"
     xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/"
@@ -18,9 +29,41 @@ TUNEIN_TEMPLATE = """
 </DIDL-Lite>' """
 TUNEIN_SERVICE = "SA_RINCON65031_"
 
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'sonos-lcd')
+
+# without events, check the favorite radio stations for changes at most
+# this often (seconds)
+RADIO_REFRESH_INTERVAL = 60
+
+# speaker states are fetched in parallel on this many threads
+STATUS_WORKERS = 4
+# connections kept open per speaker: as many as the library browse
+# workers or the status fetches send requests at once, plus commands and
+# event subscriptions besides them
+POOL_SIZE = max(BROWSE_WORKERS, STATUS_WORKERS) + 2
+# a speaker whose status request takes longer than this is shown as
+# unknown and the request given up (seconds)
+STATUS_TIMEOUT = 2
+
+
+class RadioStation():
+    """
+    uri of a favorite radio station, the DIDL metadata playing it needs
+    is only built when it's played
+    """
+    __slots__ = ('title', 'uri')
+
+    def __init__(self, title, uri):
+        self.title = title
+        self.uri = uri
+
+    def metadata(self):
+        return TUNEIN_TEMPLATE.format(title=self.title, service=TUNEIN_SERVICE)
+
 
 class Sonos():
-    def __init__(self, speakers=None):
+    def __init__(self, speakers=None, connect_timeout=connections.CONNECT_TIMEOUT,
+                 read_timeout=connections.READ_TIMEOUT):
         """
         in some setups (e.g. over VPN) then socos.discover()
         does not work, in this case do smth like:
@@ -29,126 +72,500 @@ class Sonos():
         >>> s1 = soco.Soco("192.168.188.24")
         >>> s2 = soco.Soco("192.168.188.26")
         >>> sonos.Sonos([s1, s2])
+
+        Without speakers the ones found last time are used right away
+        and discovery only confirms them in the background.
+
+        All requests to the speakers go over kept open connections, see
+        `connections.install()` for the timeouts (seconds)
         """
-        self._speakers = []
+        connections.install(connect_timeout, read_timeout, pool_size=POOL_SIZE)
+        self._topology_path = os.path.join(CACHE_DIR, 'speakers.json')
+        rediscover = False
         if speakers is None:
-            speakers = soco.discover()
-        for speaker in speakers:
-            self._speakers.append((speaker.player_name, speaker))
-        self._speakers = sorted(self._speakers)
+            self._speakers = self._load_topology()
+            if self._speakers:
+                rediscover = True
+            else:
+                self._speakers = self._discover()
+        else:
+            self._speakers = sorted((s.player_name, s) for s in speakers)
         self._library = self._speakers[0][1].music_library
+        self._index = LibraryIndex(os.path.join(CACHE_DIR, 'library.sqlite'),
+                                   on_change=self._library_changed)
+
+        self._radio_path = os.path.join(CACHE_DIR, 'radio_stations.json')
+        self._radio = None
+        self._radio_update_id = None
+        self._radio_checked = timer()
+        self._radio_lock = threading.Lock()
+        self._load_radio_stations()
+
+        self._states = {s.ip_address: SpeakerState() for _, s in self._speakers}
+        self._listeners = []
+        self._events = queue.Queue()
+        self._subscribed = False
+        self._pool = ThreadPoolExecutor(max_workers=STATUS_WORKERS)
+        self._fetching = {}
+        # ip -> when fetching its state first failed, until it succeeds
+        self._failed = {}
+        self._subscriptions = []
+        self._event_thread = None
+        self._paused = False
+        self._commands = CommandQueue(self._execute, on_error=self._command_failed)
+        self.refresh_states()
+        self._index.sync(self._library)
+        threading.Thread(target=self._subscribe, daemon=True).start()
+        if rediscover:
+            threading.Thread(target=self._rediscover, daemon=True).start()
 
     def speakers(self):
         return [s[0] for s in self._speakers]
 
+    def add_listener(self, callback):
+        """
+        callback(kind) is called (from a background thread) when
+        - kind == 'state': the state of a speaker changed, e.g. volume
+          was changed at the speaker itself
+        - kind == 'speakers': speakers were added/removed/renamed, see
+          `speakers()`
+        - kind == 'failed': a command (e.g. `change_volume()`) failed
+        - kind == 'library': a context of the library index was synced
+          or the favorite radio stations changed, search results might
+          have changed
+        - kind == 'library_progress': see `library_progress()`
+        """
+        self._listeners.append(callback)
+
+    def _notify(self, kind):
+        for callback in self._listeners:
+            callback(kind)
+
+    def _discover(self):
+        """
+        return sorted list of (name, SoCo) of the speakers on the network
+        """
+        speakers = sorted((s.player_name, s) for s in soco.discover() or [])
+        if speakers:
+            self._save_topology(speakers)
+        return speakers
+
+    def _load_topology(self):
+        try:
+            with open(self._topology_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return []
+        return [(s['name'], soco.SoCo(s['ip'])) for s in data]
+
+    def _save_topology(self, speakers):
+        data = [dict(name=name, ip=s.ip_address, uid=s.uid) for name, s in speakers]
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(self._topology_path, 'w') as f:
+            json.dump(data, f)
+
+    def _rediscover(self):
+        """
+        confirm the speakers loaded from the cache, apply changes
+        """
+        try:
+            found = self._discover()
+        except Exception as e:
+            print(f'discovery failed: {e}')
+            return
+        if not found:
+            return
+        if [(n, s.ip_address) for n, s in found] == [(n, s.ip_address) for n, s in self._speakers]:
+            return
+        for _, s in found:
+            if s.ip_address not in self._states:
+                self._states[s.ip_address] = SpeakerState()
+                if self._subscribed:
+                    self._subscribe_speaker(s)
+        if self._library.soco.ip_address not in [s.ip_address for _, s in found]:
+            self._library = found[0][1].music_library
+        self._speakers = found
+        self.refresh_states()
+        self._notify('speakers')
+
+    def _subscribe_speaker(self, s):
+        for service in (s.renderingControl, s.avTransport):
+            self._subscriptions.append(
+                service.subscribe(auto_renew=True, event_queue=self._events))
+
+    def subscribed(self):
+        """
+        True if speaker state arrives through UPnP events, if False the
+        state needs to be polled with `volume_play_as_string()`
+        """
+        return self._subscribed
+
+    def _subscribe(self):
+        """
+        subscribe to the events of all speakers, they're handled on a
+        thread which is started on the first success
+        """
+        try:
+            for _, s in self._speakers:
+                self._subscribe_speaker(s)
+            # tells when the favorite radio stations changed
+            self._subscriptions.append(self._library.contentDirectory.subscribe(
+                auto_renew=True, event_queue=self._events))
+        except Exception as e:
+            # e.g. over VPN the speakers can't reach our event listener
+            print(f'could not subscribe to events, polling instead: {e}')
+            self._unsubscribe()
+            return
+        if self._paused:
+            # went to sleep in the meantime
+            self._unsubscribe()
+            return
+        self._subscribed = True
+        if self._event_thread is None:
+            self._event_thread = threading.Thread(target=self._handle_events, daemon=True)
+            self._event_thread.start()
+
+    def _unsubscribe(self):
+        self._subscribed = False
+        subscriptions, self._subscriptions = self._subscriptions, []
+        for subscription in subscriptions:
+            try:
+                subscription.unsubscribe()
+            except Exception as e:
+                print(f'could not unsubscribe: {e}')
+
+    def pause(self):
+        """
+        stop all traffic to the speakers which is not asked for (events,
+        their renewals and polling) until `resume()`, e.g. while the
+        screen is off
+        """
+        self._paused = True
+        threading.Thread(target=self._pause, daemon=True).start()
+
+    def _pause(self):
+        self._unsubscribe()
+        # its thread only waits for events, it's started again by the
+        # next subscription
+        soco.events.event_listener.stop()
+
+    def resume(self):
+        """
+        subscribe to events again and fetch the current state of all
+        speakers, in the background
+        """
+        self._paused = False
+        threading.Thread(target=self._subscribe, daemon=True).start()
+        self.refresh_states()
+
+    def _handle_events(self):
+        while True:
+            event = self._events.get()
+            if 'radio_favorites_update_id' in event.variables:
+                self._refresh_radio_stations_async()
+            if ('system_update_id' in event.variables and
+                    event.variables.get('share_index_in_progress') != '1'):
+                # something in the library changed, the sync tells what
+                self._index.sync(self._library, update_id=event.variables['system_update_id'])
+            state = self._states.get(event.service.soco.ip_address)
+            if state is not None and state.update(event.variables):
+                self._notify('state')
+
     def search(self, context, term, offset=0, max_items=7, debug=False):
         """
         context: albums, artists, titles, sonos_playlists
         """
-        if debug:
-            start = timer()
-
         if context == 'radio_stations':
-            # search does not work for radio stations
-            soco_res = self._library.get_favorite_radio_stations()
-            res = []
-            for i in soco_res:
-                title, uri = i.title, i.get_uri()
-                uri = uri.replace('&', '&amp;')
-                metadata = TUNEIN_TEMPLATE.format(
-                    title=title, service=TUNEIN_SERVICE)
-                res.append((title, (uri, metadata)))
+            # search does not work for radio stations, filter locally
+            res = self._radio_stations()
+            if term:
+                term = term.lower()
+                res = [r for r in res if term in r[0].lower()]
+            res = res[offset:offset + max_items]
         else:
-            soco_res = self._library.get_music_library_information(context, search_term=term,
-                                                                   start=offset, max_items=7)
-            res = [(i.title, i.get_uri()) for i in soco_res]
+            with metrics.span('search.index'):
+                res = self._index.search(context, term, offset=offset, max_items=max_items)
+            if res is None:
+                # index is not built yet, ask the speaker
+                metrics.count('search.index_miss')
+                with metrics.span('soap.search'):
+                    soco_res = self._library.get_music_library_information(
+                        context, search_term=term, start=offset, max_items=max_items)
+                res = [(i.title, i.get_uri()) for i in soco_res]
+        return res
+
+    def _radio_stations(self):
+        """
+        favorite radio stations as (title, RadioStation), served from
+        the cache. Only on the very first start they're fetched right away
+        """
+        if self._radio is None:
+            metrics.count('search.radio_miss')
+            self._refresh_radio_stations()
+        elif not self._subscribed and timer() - self._radio_checked > RADIO_REFRESH_INTERVAL:
+            self._refresh_radio_stations_async()
+        return self._radio or []
 
-        if debug:
-            print(f'search {context}: {timer() - start:.2f}')
+    def _load_radio_stations(self):
+        try:
+            with open(self._radio_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._radio_update_id = data['update_id']
+        # files written by older versions have the metadata as third item
+        self._radio = [(station[0], RadioStation(*station[:2])) for station in data['stations']]
 
-        return res
+    def _refresh_radio_stations_async(self):
+        threading.Thread(target=self._refresh_radio_stations, daemon=True).start()
+
+    def _refresh_radio_stations(self):
+        """
+        fetch the favorite radio stations, they're only persisted if the
+        update id of the favorites changed
+        """
+        if not self._radio_lock.acquire(blocking=False):
+            # refresh already running
+            return
+        try:
+            self._radio_checked = timer()
+            with metrics.span('soap.radio_stations'):
+                soco_res = self._library.get_favorite_radio_stations()
+            if self._radio is not None and soco_res.update_id == self._radio_update_id:
+                return
+            res = []
+            for i in soco_res:
+                uri = i.get_uri().replace('&', '&amp;')
+                res.append((i.title, RadioStation(i.title, uri)))
+            self._radio = res
+            self._radio_update_id = soco_res.update_id
+
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(self._radio_path, 'w') as f:
+                json.dump(dict(update_id=self._radio_update_id,
+                               stations=[(t, station.uri) for t, station in res]), f)
+            self._notify('library')
+        except Exception as e:
+            print(f'could not fetch radio stations: {e}')
+        finally:
+            self._radio_lock.release()
 
     def play(self, speaker_number, uri):
         """
         speaker_number: index of `speakers()`
         uri: second item of `search_albums()`
         """
-        _, s = self._speakers[speaker_number]
-        if type(uri) == tuple:
-            # tunein
-            _uri, _meta = uri
-            s.play_uri(_uri, _meta)
-        else:
-            s.clear_queue()
-            s.add_uri_to_queue(uri=uri)
-            s.play_from_queue(index=0)
+        self._commands.put(speaker_number, 'play', uri)
 
     def add_to_queue(self, speaker_number, uri):
+        self._commands.put(speaker_number, 'add_to_queue', uri)
+
+    def state(self, speaker_number):
+        """
+        last known `SpeakerState` of the speaker, don't modify it
+        """
         _, s = self._speakers[speaker_number]
-        s.add_uri_to_queue(uri)
+        return self._states[s.ip_address]
+
+    def now_playing(self, speaker_number):
+        """
+        (title, artist, album, album art url) of the current track of the
+        speaker, None if nothing is playing or it's not known yet.
+        Never blocks
+        """
+        _, s = self._speakers[speaker_number]
+        track = self._states[s.ip_address].track
+        if track is None:
+            return None
+        return track[:3] + (self._art_url(s, track[3]),)
+
+    def album_art(self, context, uri):
+        """
+        album art url of a search result (its uri), None if unknown.
+        Never blocks
+        """
+        return self._art_url(self._speakers[0][1], self._index.album_art(context, uri))
+
+    def _art_url(self, s, uri):
+        """
+        album art uris of the library are relative to the speaker
+        """
+        if uri and uri.startswith('/'):
+            return f'http://{s.ip_address}:1400{uri}'
+        return uri or None
 
     def volume_play_as_string(self, speaker_number, debug=False):
         """
-        return string representing play/pause and volume
+        return string representing play/pause and volume.
+        Never blocks: served from the last known state (from events or
+        `refresh_states()`), empty while nothing is known yet
         """
         _, s = self._speakers[speaker_number]
-        if debug:
-            start = timer()
-        t = s.get_current_transport_info()
-
-        play_mode = ''
-        m = s.play_mode
-        if m == 'REPEAT_ALL':
-            play_mode = '© '
-        elif m == 'REPEAT_ONE':
-            play_mode = '® '
-
-        play_pause = ''
-        if t['current_transport_state'] == 'PAUSED_PLAYBACK':
-            play_pause = "| | "
-        elif t['current_transport_state'] == 'PLAYING':
-            play_pause = u"\u25B6"
-        elif t['current_transport_state'] == 'STOPPED':
-            play_pause = "\u25A0"
-        res = f'{play_mode}{play_pause} {s.volume}%'
-        if debug:
-            print(f'fetch status: {timer() - start}')
+        state = self._states[s.ip_address]
+        if not state.complete():
+            return ''
+        return state.as_string()
+
+    def speaker_status(self):
+        """
+        short play/volume indicator for every speaker of `speakers()`,
+        '?' if the speaker does not answer or its last fetch failed
+        """
+        res = []
+        for _, s in self._speakers:
+            started = self._fetching.get(s.ip_address)
+            state = self._states[s.ip_address]
+            if s.ip_address in self._failed or (
+                    started is not None and timer() - started > STATUS_TIMEOUT):
+                res.append('?')
+            elif state.complete():
+                res.append(state.as_short_string())
+            else:
+                res.append('')
         return res
 
+    def refresh_states(self, speaker_numbers=None):
+        """
+        fetch the state of all (or the given) speakers in parallel,
+        without blocking. Listeners are notified if something changed
+        """
+        if speaker_numbers is None:
+            speakers = [s for _, s in self._speakers]
+        else:
+            speakers = [self._speakers[i][1] for i in speaker_numbers]
+        for s in speakers:
+            if s.ip_address in self._fetching:
+                continue
+            self._fetching[s.ip_address] = timer()
+            self._pool.submit(self._fetch_state, s)
+
+    def _fetch_state(self, s):
+        state = self._states[s.ip_address]
+        try:
+            with metrics.span('soap.status'):
+                t, play_mode, volume, track = connections.batch(
+                    s.get_current_transport_info, lambda: s.play_mode, lambda: s.volume,
+                    s.get_current_track_info, timeout=STATUS_TIMEOUT)
+                changed = state.update(dict(
+                    transport_state=t['current_transport_state'],
+                    current_play_mode=play_mode, volume=volume,
+                    track=(track['title'], track['artist'], track['album'], track['album_art'])
+                    if track['title'] else None))
+        except Exception as e:
+            if s.ip_address not in self._failed:
+                # printed once, it's polled again and again
+                print(f'could not fetch state of {s.ip_address}: {e}')
+                self._failed[s.ip_address] = timer()
+                changed = True
+            else:
+                changed = False
+        else:
+            if self._failed.pop(s.ip_address, None) is not None:
+                print(f'{s.ip_address} answers again')
+                changed = True
+        finally:
+            del self._fetching[s.ip_address]
+        if changed:
+            self._notify('state')
+
+    def _after_command(self, speaker_number):
+        """
+        without events the state of the speaker needs to be fetched
+        after it was changed
+        """
+        if not self._subscribed:
+            self.refresh_states([speaker_number])
+
     def next(self, speaker_number):
-        self._speakers[speaker_number][1].next()
+        self._commands.put(speaker_number, 'next')
 
     def previous(self, speaker_number):
-        self._speakers[speaker_number][1].previous()
+        self._commands.put(speaker_number, 'previous')
 
     def change_volume(self, speaker_number, diff):
-        _, s = self._speakers[speaker_number]
-        s.volume += diff
+        self._commands.put(speaker_number, 'volume', diff)
 
     def play_pause(self, speaker_number):
         """
         pause if playing, play if pausing
         """
-        _, s = self._speakers[speaker_number]
-        t = s.get_current_transport_info()
-        if t['current_transport_state'] == 'PAUSED_PLAYBACK':
-            s.play()
-        elif t['current_transport_state'] == 'PLAYING':
-            s.pause()
+        self._commands.put(speaker_number, 'play_pause', 1)
+
+    def cycle_repeat(self, speaker_number):
+        """
+        normal -> repeat all -> repeat one -> normal
+        """
+        self._commands.put(speaker_number, 'repeat', 1)
 
     def reindex(self):
-        soco.music_library.MusicLibrary().start_library_update()
+        """
+        let the speaker rescan the music shares and sync the local
+        search index once it's done
+        """
+        self._library.start_library_update()
+        self._index.sync(self._library, wait_for_update=True)
 
-    def cycle_repeat(self, speaker_number):
+    def _library_changed(self, context):
+        self._notify('library_progress' if context is None else 'library')
+
+    def library_progress(self):
+        """
+        how far the library sync is (0..1), None if it's not running
+        """
+        progress = self._index.progress()
+        if progress is None:
+            return None
+        fetched, total = progress
+        return fetched / total if total else 0
+
+    def _execute(self, speaker_number, kind, arg):
+        """
+        run a command of `self._commands` (on its worker thread)
+        """
         _, s = self._speakers[speaker_number]
-        m1 = s.play_mode
-        if m1 == 'NORMAL':
-            m2 = 'REPEAT_ALL'
-        elif m1 == 'REPEAT_ALL':
-            m2 = 'REPEAT_ONE'
-        else:
-            m2 = 'NORMAL'
-        s.play_mode = m2
+        state = self._states[s.ip_address]
+        changed = False
+        if kind == 'play':
+            if isinstance(arg, RadioStation):
+                s.play_uri(arg.uri, arg.metadata())
+            else:
+                s.clear_queue()
+                s.add_uri_to_queue(uri=arg)
+                s.play_from_queue(index=0)
+                self._index.record_play(arg)
+        elif kind == 'add_to_queue':
+            s.add_uri_to_queue(arg)
+        elif kind == 'next':
+            s.next()
+        elif kind == 'previous':
+            s.previous()
+        elif kind == 'volume':
+            # all merged changes in one SetVolume, starting from the last
+            # known volume instead of asking the speaker first
+            volume = state.volume if state.volume is not None else s.volume
+            volume = max(0, min(100, volume + arg))
+            s.volume = volume
+            changed = state.update(dict(volume=volume))
+        elif kind == 'play_pause':
+            transport_state = s.get_current_transport_info()['current_transport_state']
+            if transport_state == 'PAUSED_PLAYBACK':
+                s.play()
+                changed = state.update(dict(transport_state='PLAYING'))
+            elif transport_state == 'PLAYING':
+                s.pause()
+                changed = state.update(dict(transport_state='PAUSED_PLAYBACK'))
+        elif kind == 'repeat':
+            mode = next_play_mode(s.play_mode, arg)
+            s.play_mode = mode
+            changed = state.update(dict(current_play_mode=mode))
+        if changed:
+            self._notify('state')
+        self._after_command(speaker_number)
+
+    def _command_failed(self, speaker_number, kind, arg, error):
+        print(f'{kind} on {self._speakers[speaker_number][0]} failed: {error}')
+        self.refresh_states([speaker_number])
+        self._notify('failed')
 
 
 if __name__ == '__main__':
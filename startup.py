@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+measure how long the phases of starting up take, to keep track of the
+time from boot to the first frame on the Pi Zero
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+STARTUP_REPORT_PATH = '/tmp/sonos_lcd_startup.txt'
+
+
+def uptime():
+    """
+    seconds since boot, None if not on linux
+    """
+    try:
+        with open('/proc/uptime') as f:
+            return float(f.read().split()[0])
+    except OSError:
+        return None
+
+
+def process_age():
+    """
+    seconds since this process was started (includes the interpreter
+    startup and module imports), None if not on linux
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # process name might contain spaces, fields start after the ')'
+            fields = f.read().rsplit(')', 1)[1].split()
+        started = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+    now = uptime()
+    if now is None:
+        return None
+    return now - started
+
+
+class Startup():
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.age_at_start = process_age()
+        self.first_frame = None
+        self.phases = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        record start (relative to creating this object) and duration of
+        the block, phases can run in parallel threads
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.phases.append((name, start - self.start, end - start))
+
+    def frame_shown(self):
+        """
+        call after the first frame was sent to the display
+        """
+        self.first_frame = (time.perf_counter() - self.start, uptime())
+
+    def report(self):
+        lines = []
+        if self.age_at_start is not None:
+            lines.append(f'{"interpreter + imports":24} {self.age_at_start:7.3f}s')
+        for name, start, duration in sorted(self.phases, key=lambda p: p[1]):
+            lines.append(f'{name:24} {duration:7.3f}s  (at +{start:.3f}s)')
+        if self.first_frame is not None:
+            after_start, since_boot = self.first_frame
+            lines.append(f'{"first frame":24} at +{after_start:.3f}s')
+            if since_boot is not None:
+                lines.append(f'{"boot to first frame":24} {since_boot:7.3f}s')
+        lines.append(f'{"total":24} {time.perf_counter() - self.start:7.3f}s')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path=STARTUP_REPORT_PATH):
+        with open(path, 'w') as f:
+            f.write(self.report())
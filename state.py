@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+local model of the state of a speaker, kept up to date from UPnP events
+(RenderingControl and AVTransport) instead of polling the speaker
+"""
+
+# repeat modes in the order `cycle_repeat()` steps through them
+PLAY_MODES = ['NORMAL', 'REPEAT_ALL', 'REPEAT_ONE']
+
+
+def next_play_mode(mode, steps=1):
+    """
+    play mode after cycling `steps` times from mode. Modes which are not
+    cycled through (e.g. shuffle) go to normal on the first step
+    """
+    first = PLAY_MODES.index(mode) + 1 if mode in PLAY_MODES else 0
+    return PLAY_MODES[(first + steps - 1) % len(PLAY_MODES)]
+
+
+class SpeakerState():
+    def __init__(self):
+        self.transport_state = None
+        self.play_mode = None
+        self.volume = None
+        # (title, artist, album, album art uri) of the current track
+        self.track = None
+
+    def complete(self):
+        """
+        is everything known which is needed for `as_string()`?
+        """
+        return None not in (self.transport_state, self.play_mode, self.volume)
+
+    def copy(self):
+        state = SpeakerState()
+        state.transport_state = self.transport_state
+        state.play_mode = self.play_mode
+        state.volume = self.volume
+        state.track = self.track
+        return state
+
+    def same(self, other):
+        return ((self.transport_state, self.play_mode, self.volume) ==
+                (other.transport_state, other.play_mode, other.volume))
+
+    def apply(self, kind, arg):
+        """
+        change the state the way command `kind` (see `commands.MERGE`)
+        is expected to change the speaker
+        """
+        if kind == 'volume':
+            self.volume = max(0, min(100, self.volume + arg))
+        elif kind == 'play_pause' and arg % 2:
+            if self.transport_state == 'PLAYING':
+                self.transport_state = 'PAUSED_PLAYBACK'
+            elif self.transport_state == 'PAUSED_PLAYBACK':
+                self.transport_state = 'PLAYING'
+        elif kind == 'repeat':
+            self.play_mode = next_play_mode(self.play_mode, arg)
+
+    def update(self, variables):
+        """
+        apply the variables of a soco event, returns True if something
+        changed
+        """
+        before = (self.transport_state, self.play_mode, self.volume, self.track)
+        if 'transport_state' in variables:
+            self.transport_state = variables['transport_state']
+        if 'current_play_mode' in variables:
+            self.play_mode = variables['current_play_mode']
+        if 'volume' in variables:
+            volume = variables['volume']
+            if isinstance(volume, dict):
+                volume = volume.get('Master')
+            if volume is not None:
+                self.volume = int(volume)
+        if 'current_track_meta_data' in variables:
+            # DIDL object of the track, empty if nothing is playing
+            meta = variables['current_track_meta_data']
+            if hasattr(meta, 'title'):
+                self.track = (meta.title, getattr(meta, 'creator', None),
+                              getattr(meta, 'album', None), getattr(meta, 'album_art_uri', None))
+            else:
+                self.track = None
+        if 'track' in variables:
+            self.track = variables['track']
+        return before != (self.transport_state, self.play_mode, self.volume, self.track)
+
+    def as_string(self):
+        """
+        return string representing repeat mode, play/pause and volume
+        """
+        play_mode = ''
+        if self.play_mode == 'REPEAT_ALL':
+            play_mode = '© '
+        elif self.play_mode == 'REPEAT_ONE':
+            play_mode = '® '
+
+        play_pause = ''
+        if self.transport_state == 'PAUSED_PLAYBACK':
+            play_pause = "| | "
+        elif self.transport_state == 'PLAYING':
+            play_pause = u"\u25B6"
+        elif self.transport_state == 'STOPPED':
+            play_pause = "\u25A0"
+        return f'{play_mode}{play_pause} {self.volume}%'
+
+    def as_short_string(self):
+        """
+        compact play/pause and volume, e.g. for the speaker bar
+        """
+        play_pause = ''
+        if self.transport_state == 'PAUSED_PLAYBACK':
+            play_pause = "||"
+        elif self.transport_state == 'PLAYING':
+            play_pause = u"\u25B6"
+        return f'{play_pause}{self.volume}'